@@ -0,0 +1,276 @@
+import argparse
+import itertools
+import json
+import sys
+import tracemalloc
+from functools import partial
+from timeit import default_timer
+
+import numpy as np
+import pyopencl as cl
+import pyopencl.array
+
+from gpWFC.metrics import Metrics
+from gpWFC.models import Model2d, Model3d, Tile
+from gpWFC.observers import CLObserver, CPUObserver
+from gpWFC.propagators import CPUPropagator, AC4Propagator, NumpyPropagator, CL1Propagator
+from gpWFC.runners import Runner, BacktrackingRunner
+
+engines = {
+	'cpu': (CPUObserver, CPUPropagator),
+	'ac4': (CPUObserver, AC4Propagator),
+	'numpy': (CPUObserver, NumpyPropagator),
+	'cl': (CLObserver, CL1Propagator),
+	'frontier': (CLObserver, partial(CL1Propagator, frontier=True)),
+	'tiled': (CLObserver, partial(CL1Propagator, tiled=True)),
+}
+
+# what a propagation turn is for each engine, turns are only comparable between engines with the same unit
+turn_units = {
+	'cpu': 'cell taken off the worklist',
+	'ac4': 'tile ban whose supports were withdrawn',
+	'numpy': 'sweep over the world',
+	'cl': 'sweep over the world',
+	'frontier': 'step of the frontier',
+	'tiled': 'sweep over the blocks',
+}
+
+def make_model(shape, tiles):
+	# a fixed random pick of edge colourings, the uniform tiles are always there so most runs succeed
+	Model = Model3d if len(shape) == 3 else Model2d
+	model = Model(shape)
+	adjacent = len(model.offsets)
+	colors = 2
+	while colors ** adjacent < tiles:
+		colors += 1
+
+	adjs = list(itertools.product(range(colors), repeat=adjacent))
+	uniform = [adj for adj in adjs if len(set(adj)) == 1]
+	others = [adj for adj in adjs if len(set(adj)) > 1]
+	order = np.random.RandomState(tiles).permutation(len(others))
+	for adj in (uniform + [others[i] for i in order])[:tiles]:
+		model.add(Tile(adj))
+	return model
+
+def device_bytes(*objects):
+	# device memory held by the buffers of the runner, observer and propagator
+	total = 0
+	for obj in objects:
+		for value in vars(obj).values():
+			values = value if isinstance(value, (list, tuple)) else [value]
+			total += sum(v.nbytes for v in values if isinstance(v, cl.array.Array))
+	return total
+
+def run_case(ctx, engine, shape, tiles, backtracking, seeds):
+	Observer, Propagator = engines[engine]
+	if backtracking:
+		snapshot_every, depth = backtracking
+		Make = partial(BacktrackingRunner, snapshot_every=snapshot_every, depth=depth)
+	else:
+		Make = Runner
+
+	model = make_model(shape, tiles)
+	np.random.seed(seeds[0])
+	start = default_timer()
+	metrics = Metrics(profile=Observer.on_device)
+	runner = Make(model, Observer=Observer, Propagator=Propagator, ctx=ctx if Observer.on_device else None, hooks=metrics)
+	setup = default_timer() - start
+	setup_phases = metrics.summary()['phases']
+
+	parts = (runner, runner.observer, runner.propagator)
+	statuses = []
+	steps = 0
+	elapsed = 0
+	turns = runner.turns
+	transferred = sum(part.transferred for part in parts)
+	for seed in seeds:
+		start = default_timer()
+		status = runner.reset(seed=seed)
+		for status in runner.run():
+			steps += 1
+		elapsed += default_timer() - start
+		statuses.append(status)
+	summary = metrics.summary()
+
+	# tracing allocations slows the host engines down a lot, so peak memory gets an untimed run of its own
+	tracemalloc.start()
+	traced = Make(model, Observer=Observer, Propagator=Propagator, ctx=ctx if Observer.on_device else None)
+	for seed in seeds:
+		traced.solve(seed=seed)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+
+	for name, phase in setup_phases.items():
+		summary['phases'][name]['seconds'] -= phase['seconds']
+		summary['phases'][name]['calls'] -= phase['calls']
+
+	return {
+		'engine': engine,
+		'shape': list(shape),
+		'tiles': len(model.tiles),
+		'backtracking': list(backtracking) if backtracking else None,
+		'seeds': list(seeds),
+		'statuses': statuses,
+		'setup_s': setup,
+		'elapsed_s': elapsed,
+		'steps': steps,
+		'steps_per_s': steps / elapsed if elapsed else None,
+		'turns': runner.turns - turns,
+		'turn_unit': turn_units[engine],
+		'transferred_bytes': sum(part.transferred for part in parts) - transferred,
+		'peak_host_bytes': peak,
+		'device_bytes': device_bytes(*parts),
+		'phases': summary['phases'],
+		'kernels': summary['kernels'],
+		'backtracks': summary['backtracks'],
+	}
+
+def valid(model, grid):
+	# every cell holds a single tile, which fits each of its neighbours
+	bits = model.to_bits(grid).reshape(-1, len(model.tiles))
+	if not (bits.sum(axis=1) == 1).all():
+		return False
+	tiles = bits.argmax(axis=1)
+	neighbours = model.get_neighbour_table().reshape(len(tiles), -1)
+	fits = model.get_compatibility()[np.arange(neighbours.shape[1]), tiles[:, np.newaxis], tiles[neighbours]]
+	# past the edge of the world a cell is its own neighbour
+	return bool((fits | (neighbours == np.arange(len(tiles))[:, np.newaxis])).all())
+
+def check_case(ctx, engine, shape, tiles, backtracking, seeds):
+	# contradictions are rare with these models, so each run rules out one of its decisions halfway as if it had hit one.
+	# the tiles left for that cell are then written from the host, and the run still has to end in a valid world
+	Observer, Propagator = engines[engine]
+	snapshot_every, depth = backtracking or (4, 8)
+	model = make_model(shape, tiles)
+	metrics = Metrics()
+	runner = BacktrackingRunner(model, Observer=Observer, Propagator=Propagator, ctx=ctx if Observer.on_device else None,
+		hooks=metrics, snapshot_every=snapshot_every, depth=depth)
+
+	statuses = []
+	invalid = []
+	for seed in seeds:
+		status = runner.reset(seed=seed)
+		for status in itertools.islice(runner.run(), int(np.prod(shape)) // 2):
+			pass
+		came_back = False
+		if not runner.done:
+			runner.conflict = int(np.ravel(runner.candidate[0])[0])
+			if runner.backtrack():
+				# unless it has to backtrack again right away, the cell keeps to the tiles that were left
+				index, remaining = runner.candidate
+				backtracks = len(metrics.backtracks)
+				status = runner.step()
+				runner.fetch()
+				cell = runner.grid_array.reshape((-1,) + model.cell_shape)[index]
+				came_back = len(metrics.backtracks) == backtracks and model.to_int(cell) & ~model.to_int(remaining)
+				if not runner.done:
+					status = runner.finish()
+		statuses.append(status)
+		runner.fetch()
+		if came_back or status == 'done' and not valid(model, runner.grid_array):
+			invalid.append(seed)
+
+	return {
+		'engine': engine,
+		'shape': list(shape),
+		'tiles': len(model.tiles),
+		'backtracking': [snapshot_every, depth],
+		'seeds': list(seeds),
+		'statuses': statuses,
+		'backtracks': metrics.summary()['backtracks'],
+		'invalid_seeds': invalid,
+	}
+
+def case_key(case):
+	return (case['engine'], tuple(case['shape']), case['tiles'], tuple(case['backtracking'] or ()))
+
+def compare(results, baseline, tolerance):
+	# cases that got slower than the baseline by more than tolerance, or fail for seeds that used to work
+	previous = {case_key(case): case for case in baseline['cases']}
+	regressions = []
+	for case in results['cases']:
+		old = previous.get(case_key(case))
+		if not old or 'skipped' in case or 'skipped' in old:
+			continue
+
+		ratio = case['steps_per_s'] / old['steps_per_s'] if case['steps_per_s'] and old['steps_per_s'] else 1.0
+		case['baseline_ratio'] = ratio
+		failing = [seed for seed, status, old_status in zip(case['seeds'], case['statuses'], old['statuses'])
+			if status != 'done' and old_status == 'done']
+		if ratio < 1 - tolerance or failing:
+			regressions.append((case_key(case), ratio, failing))
+	return regressions
+
+def parse_shape(text):
+	return tuple(int(size) for size in text.split('x'))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='benchmark the engines over world sizes, tile counts and backtracking settings')
+	parser.add_argument('--engines', nargs='+', default=sorted(engines), choices=sorted(engines))
+	parser.add_argument('--shapes', nargs='+', type=parse_shape, default=[(16, 16), (32, 32), (64, 64), (8, 8, 8)],
+		help='world shapes like 32x32 or 8x8x8')
+	parser.add_argument('--tiles', nargs='+', type=int, default=[8, 16, 32, 128])
+	parser.add_argument('--backtracking', nargs='+', default=['none', '4x8', '1x16'],
+		help='none for the plain Runner, or snapshot_every x depth for the BacktrackingRunner')
+	parser.add_argument('--seeds', nargs='+', type=int, default=[0, 1, 2])
+	parser.add_argument('--output', help='write the results as JSON to this file instead of stdout')
+	parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+	parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown against the baseline')
+	parser.add_argument('--check', action='store_true',
+		help='instead of timing, backtrack once in every run and check that the worlds come out valid')
+	args = parser.parse_args()
+
+	backtrackings = [None if text == 'none' else parse_shape(text) for text in args.backtracking]
+
+	# OpenCL engines use the device picked by PYOPENCL_CTX, for example a CPU device like pocl
+	ctx = None
+	if any(engines[engine][0].on_device for engine in args.engines):
+		try:
+			ctx = cl.create_some_context(interactive=False)
+		except cl.Error as e:
+			print('no OpenCL device, skipping those engines: {}'.format(e), file=sys.stderr)
+
+	results = {
+		'device': ctx.devices[0].name if ctx else None,
+		'cases': [],
+	}
+	for engine, shape, tiles, backtracking in itertools.product(args.engines, args.shapes, args.tiles, backtrackings):
+		print('{} {} {} tiles {}'.format(engine, 'x'.join(map(str, shape)), tiles, backtracking), file=sys.stderr)
+		skipped = {
+			'engine': engine, 'shape': list(shape), 'tiles': tiles,
+			'backtracking': list(backtracking) if backtracking else None,
+		}
+		if engines[engine][0].on_device and not ctx:
+			results['cases'].append(dict(skipped, skipped='no OpenCL device'))
+			continue
+
+		try:
+			results['cases'].append((check_case if args.check else run_case)(ctx, engine, shape, tiles, backtracking, args.seeds))
+		except cl.Error as e:
+			print('skipped: {}'.format(e), file=sys.stderr)
+			results['cases'].append(dict(skipped, skipped=str(e)))
+
+	regressions = []
+	if args.baseline:
+		with open(args.baseline) as f:
+			regressions = compare(results, json.load(f), args.tolerance)
+		results['regressions'] = [
+			{'case': list(key), 'ratio': ratio, 'failing_seeds': failing}
+			for key, ratio, failing in regressions
+		]
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=2)
+	else:
+		json.dump(results, sys.stdout, indent=2)
+		print()
+
+	for key, ratio, failing in regressions:
+		print('regression in {}: {:.2f}x the baseline speed, failing seeds {}'.format(key, ratio, failing), file=sys.stderr)
+
+	# checks fail when the backtracking path never ran, or a world came out broken
+	broken = [case for case in results['cases'] if args.check and 'skipped' not in case and (not case['backtracks'] or case['invalid_seeds'])]
+	for case in broken:
+		print('check failed for {}: {} backtracks, invalid seeds {}'.format(case_key(case), case['backtracks'], case['invalid_seeds']), file=sys.stderr)
+	sys.exit(1 if regressions or broken else 0)
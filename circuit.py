@@ -1,7 +1,5 @@
 from gpWFC.models import Model2d, SpriteTile
-from gpWFC.previews import SpritePreviewWindow
 from gpWFC.runners import BacktrackingRunner
-from pyglet import app, image, clock
 import sys
 
 model = Model2d((16, 16))
@@ -42,6 +40,13 @@ model.add_rotations(SpriteTile('tiles/dskew.png', (1, 1, 1, 1), weight=2), [0, 1
 model.add(SpriteTile('tiles/substrate.png', (0, 0, 0, 0), weight=2))
 
 runner = BacktrackingRunner(model)
+
+if 'headless' in sys.argv[1:]:
+	from gpWFC.renderers import AtlasRenderer
+	AtlasRenderer(model).record(runner)
+	sys.exit()
+
+from gpWFC.previews import SpritePreviewWindow
 preview = SpritePreviewWindow(runner, 14)
 
 if 'render' in sys.argv[1:]:
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import pickle
+import numpy as np
+import pyopencl as cl
+import pyopencl.tools
+
+# compiled programs, struct layouts and model tables are kept here between runs, nothing is when unset
+directory = os.environ.get('GPWFC_CACHE_DIR') or None
+# part of the key of every table, raised whenever the layout of the tables changes
+table_version = 2
+
+def use(path):
+	# None turns the cache off again
+	global directory
+	directory = path
+
+def subdirectory(name):
+	if not directory:
+		return None
+	path = os.path.join(directory, name)
+	os.makedirs(path, exist_ok=True)
+	return path
+
+def save_atomically(path, save):
+	# written next to the target and renamed, so other processes never read half a file
+	temporary = '{}.{}.tmp'.format(path, os.getpid())
+	with open(temporary, 'wb') as f:
+		save(f)
+	os.replace(temporary, path)
+
+def program_directory():
+	# for Program.build, which keys the binaries by device, source and options itself
+	return subdirectory('programs')
+
+def model_signature(model):
+	# everything the neighbour and allow tables depend on, the adjacency through the compatibility of the tiles
+	h = hashlib.sha1(repr((
+		table_version, type(model).__name__, tuple(model.world_shape), model.wraps, model.adjacent, model.offsets, len(model.tiles),
+		model.cell_dtype.str, model.words
+	)).encode())
+	h.update(np.ascontiguousarray(model.get_compatibility()).tobytes())
+	return h.hexdigest()
+
+def load_table(model, name, compute):
+	# memory-mapped read-only when cached, computed and saved otherwise
+	path = subdirectory('tables')
+	if not path:
+		return compute()
+
+	path = os.path.join(path, '{}-{}.npy'.format(model.get_signature(), name))
+	if os.path.exists(path):
+		try:
+			return np.load(path, mmap_mode='r')
+		except (ValueError, OSError):
+			# unreadable, computed and written again
+			pass
+	table = compute()
+	save_atomically(path, lambda f: np.save(f, table))
+	return table
+
+def match_struct(device, name, dtype):
+	# match_dtype_to_c_struct builds and runs a kernel to find out the layout on the device
+	path = subdirectory('structs')
+	if not path:
+		return cl.tools.match_dtype_to_c_struct(device, name, dtype)
+
+	key = repr((device.platform.name, device.name, device.driver_version, name, dtype.descr))
+	path = os.path.join(path, '{}.pickle'.format(hashlib.sha1(key.encode()).hexdigest()))
+	if os.path.exists(path):
+		try:
+			with open(path, 'rb') as f:
+				return pickle.load(f)
+		except (ValueError, OSError, EOFError, pickle.UnpicklingError):
+			pass
+	result = cl.tools.match_dtype_to_c_struct(device, name, dtype)
+	save_atomically(path, lambda f: pickle.dump(result, f))
+	return result
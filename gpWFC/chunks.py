@@ -0,0 +1,69 @@
+from itertools import count, product
+from .observers import CLObserver
+from .propagators import CL1Propagator
+from .runners import BacktrackingRunner
+
+class ChunkGenerator(object):
+	def __init__(self, model, Observer=CLObserver, Propagator=CL1Propagator, Runner=BacktrackingRunner, ctx=None, attempts=4, **kwargs):
+		# the model describes a single chunk, which is constrained by its neighbours instead of wrapping around
+		assert not any(model.wraps)
+		self.model = model
+		self.attempts = attempts
+
+		# the direction back from the neighbour in each direction, and the side of a chunk facing it
+		self.opposite = [self.model.offsets.index(tuple(-o for o in offset)) for offset in self.model.offsets]
+		self.sides = [
+			tuple(
+				(-1 if o > 0 else 0) if o else slice(None)
+				for o in offset
+			)
+			for offset in self.model.offsets
+		]
+
+		# only the outermost tiles of each solved chunk are kept, for the chunks around it
+		self.faces = {}
+
+		# one runner for all chunks, so kernels and tables are only set up once
+		self.runner = Runner(model, Observer=Observer, Propagator=Propagator, ctx=ctx, **kwargs)
+
+	def constrain(self, pos):
+		grid = self.model.build_grid()
+		for direction, offset in enumerate(self.model.offsets):
+			neighbour = tuple(p + o for p, o in zip(pos, offset))
+			if not neighbour in self.faces:
+				continue
+
+			# tiles on our side have to fit next to the solved tiles on the other side
+			face = self.faces[neighbour][self.opposite[direction]]
+			grid[self.sides[direction]] &= self.model.get_fitting(face, direction)
+		return grid
+
+	def solve(self, pos):
+		status = self.runner.solve(self.constrain(pos), attempts=self.attempts)
+		if status != 'done':
+			return status, None
+
+		self.runner.fetch()
+		result = self.runner.grid_array.copy()
+		self.faces[pos] = [result[side].copy() for side in self.sides]
+		return status, result
+
+	def forget(self, pos):
+		self.faces.pop(pos, None)
+
+	def generate(self, positions):
+		# chunks that fail are left unsolved, the ones around them are not constrained by them
+		for pos in positions:
+			pos = tuple(pos)
+			status, grid = self.solve(pos)
+			yield pos, status, grid
+
+	def stream(self, extent):
+		# endless band of chunks along the first axis, `extent` chunks wide along the others.
+		# each slice only depends on the one before, so older ones are forgotten along the way
+		for first in count():
+			rest = product(*(range(size) for size in extent))
+			yield from self.generate((first,) + other for other in rest)
+
+			for other in product(*(range(size) for size in extent)):
+				self.forget((first - 1,) + other)
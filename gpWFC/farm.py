@@ -0,0 +1,80 @@
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from timeit import default_timer
+import traceback
+import numpy as np
+from .observers import CPUObserver
+from .propagators import NumpyPropagator
+from .runners import BacktrackingRunner
+
+# state of the current worker process, set up once by _init_worker
+_worker = {}
+
+def _init_worker(make_model, Observer, Propagator, Runner, shm_name, shape, dtype):
+	model = make_model()
+	shm = SharedMemory(name=shm_name)
+	_worker['shm'] = shm
+	_worker['grids'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+	_worker['runner'] = Runner(model, Observer=Observer, Propagator=Propagator)
+
+def _run_job(job):
+	i, seed = job
+	runner = _worker['runner']
+
+	start = default_timer()
+	try:
+		runner.reset(seed=seed)
+		status = runner.finish()
+		runner.fetch()
+		_worker['grids'][i] = runner.grid_array
+	except Exception:
+		# one seed that breaks doesn't take the rest of the farm with it, the next reset starts over anyway
+		traceback.print_exc()
+		status = 'error'
+
+	return i, status, default_timer() - start
+
+class SeedFarm(object):
+	def __init__(self, make_model, seeds, Observer=CPUObserver, Propagator=NumpyPropagator, Runner=BacktrackingRunner, processes=None):
+		self.seeds = list(seeds)
+		model = make_model()
+		grid_shape, dtype = model.grid_shape, model.cell_dtype
+
+		# solved grids are written straight into shared memory by the workers
+		shape = (len(self.seeds),) + grid_shape
+		nbytes = max(1, int(np.prod(shape)) * dtype.itemsize)
+		self.shm = SharedMemory(create=True, size=nbytes)
+		self.grids = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+		self.grids[...] = 0
+
+		self.statuses = [None] * len(self.seeds)
+		self.timings = np.zeros(len(self.seeds))
+
+		self.pool = Pool(processes, initializer=_init_worker,
+			initargs=(make_model, Observer, Propagator, Runner, self.shm.name, shape, dtype))
+
+	def run(self):
+		jobs = enumerate(self.seeds)
+		for i, status, time in self.pool.imap_unordered(_run_job, jobs):
+			self.statuses[i] = status
+			self.timings[i] = time
+			yield i, status
+
+	def finish(self):
+		for _ in self.run():
+			pass
+		return self.statuses
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+		# keep the results around after the shared memory is gone
+		self.grids = self.grids.copy()
+		self.shm.close()
+		self.shm.unlink()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
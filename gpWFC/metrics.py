@@ -0,0 +1,117 @@
+from collections import defaultdict
+from timeit import default_timer
+import numpy as np
+
+def timed(hooks, phase, function, *args, **kwargs):
+	# without hooks this is just the call
+	if not hooks:
+		return function(*args, **kwargs)
+	start = default_timer()
+	result = function(*args, **kwargs)
+	hooks.phase(phase, default_timer() - start)
+	return result
+
+class Hooks(object):
+	# called by the runners, observers and propagators while they work, these do nothing
+	# whether command queues record OpenCL event profiling times for kernel()
+	profile = False
+
+	def phase(self, name, seconds):
+		# observe, collapse, propagate, readback, snapshot or restore took this long on the host
+		pass
+
+	def turns(self, turns):
+		# a propagation settled after this many turns
+		pass
+
+	def observed(self, model, status):
+		# status as returned by the observer
+		pass
+
+	def backtracked(self, levels):
+		# went back this many snapshots, or None when there was nothing left to go back to
+		pass
+
+	def kernel(self, name, event):
+		# an OpenCL kernel was enqueued, the event may still be running
+		pass
+
+class Metrics(Hooks):
+	# collects everything, see summary()
+	def __init__(self, profile=False):
+		self.profile = profile
+		self.seconds = defaultdict(float)
+		self.calls = defaultdict(int)
+		self.turn_counts = []
+		self.statuses = defaultdict(int)
+		self.collapsed = 0
+		self.backtracks = []
+		self.kernel_seconds = defaultdict(float)
+		self.kernel_calls = defaultdict(int)
+		self.pending = []
+
+	def phase(self, name, seconds):
+		self.seconds[name] += seconds
+		self.calls[name] += 1
+		# every phase ends with the queue drained, so the kernels before it are done
+		self.flush()
+
+	def turns(self, turns):
+		self.turn_counts.append(turns)
+
+	def observed(self, model, status):
+		self.statuses[status[0]] += 1
+		if status[0] == 'continue':
+			self.collapsed += np.size(status[1])
+
+	def backtracked(self, levels):
+		self.backtracks.append(levels)
+
+	def kernel(self, name, event):
+		if self.profile:
+			self.pending.append((name, event))
+
+	def flush(self):
+		for name, event in self.pending:
+			event.wait()
+			self.kernel_seconds[name] += (event.profile.end - event.profile.start) * 1e-9
+			self.kernel_calls[name] += 1
+		self.pending = []
+
+	def summary(self):
+		self.flush()
+		return {
+			'phases': {name: {'seconds': self.seconds[name], 'calls': self.calls[name]} for name in self.seconds},
+			'turns': sum(self.turn_counts),
+			'propagations': len(self.turn_counts),
+			'statuses': dict(self.statuses),
+			'collapsed': self.collapsed,
+			'backtracks': len([levels for levels in self.backtracks if levels is not None]),
+			'backtracked_levels': sum(levels for levels in self.backtracks if levels is not None),
+			'gave_up': self.backtracks.count(None),
+			'kernels': {name: {'seconds': self.kernel_seconds[name], 'calls': self.kernel_calls[name]} for name in self.kernel_seconds},
+		}
+
+class PrintHooks(Hooks):
+	# the step by step log of the interactive examples
+	def position(self, model, index):
+		return tuple(int(i) for i in np.unravel_index(index, model.world_shape))
+
+	def turns(self, turns):
+		print('propagated in {} turns'.format(turns))
+
+	def observed(self, model, status):
+		if status[0] == 'done':
+			print('solved!')
+		elif status[0] == 'error':
+			print('tile {} overconstrained!'.format(self.position(model, status[1])))
+		elif np.ndim(status[1]):
+			print('collapsed {} tiles'.format(len(status[1])))
+		else:
+			print('collapsed tile {} to {}'.format(self.position(model, status[1]), model.to_int(status[2])))
+
+	def backtracked(self, levels):
+		if levels is None:
+			print('cannot backtrack anymore')
+		else:
+			print('backtracking {} levels'.format(levels))
@@ -1,7 +1,10 @@
-import pyopencl as cl
-import pyopencl.cltypes
 import numpy as np
 import pyglet
+from . import cache
+
+# cells are stored in the narrowest of these that has a bit for every tile, with the matching OpenCL C type.
+# with more tiles than that, cells are several 64 bit words along an extra last axis of the grid
+cell_types = ((np.uint8, 'uchar'), (np.uint16, 'ushort'), (np.uint32, 'uint'), (np.uint64, 'ulong'))
 
 class Tile(object):
 	def __init__(self, adj, weight=1):
@@ -14,7 +17,8 @@ class Tile(object):
 
 	def register(self, index):
 		self.index = index
-		self.flag = np.uint64(1 << self.index)
+		# a Python int, which has room for any number of tiles
+		self.flag = 1 << self.index
 
 	def compatible(self, other, direction):
 		l = len(self.adj)
@@ -23,66 +27,341 @@ class Tile(object):
 class SpriteTile(Tile):
 	def __init__(self, image, adj, weight=1, rotation=0):
 		super().__init__(adj, weight)
-		if not isinstance(image, pyglet.image.AbstractImage):
-			image = pyglet.resource.image(image)
-		self.image = image
+		# an image or the name of a resource, which is only loaded once a preview needs it
+		self.source = image
 		self.rotation = rotation
 
+	@property
+	def image(self):
+		if not isinstance(self.source, pyglet.image.AbstractImage):
+			self.source = pyglet.resource.image(self.source)
+		return self.source
+
 	def rotated(self, rotation):
 		adj = self.adj[-rotation:] + self.adj[:-rotation]
-		return SpriteTile(self.image, adj, weight=self.weight, rotation=rotation)
+		return SpriteTile(self.source, adj, weight=self.weight, rotation=rotation)
 
 class Model(object):
-	def __init__(self, world_shape):
+	# relative position of each neighbour, in direction order
+	offsets = None
+
+	def __init__(self, world_shape, periodic=True):
 		self.tiles = []
 		self.world_shape = world_shape
+		# whether the world wraps around at its edges, or a tuple with that for each axis
+		self.periodic = periodic
+		self.tables = {}
+
+	@property
+	def wraps(self):
+		# whether the world wraps around along each axis
+		if isinstance(self.periodic, (tuple, list)):
+			return tuple(bool(wraps) for wraps in self.periodic)
+		return (bool(self.periodic),) * len(self.world_shape)
 
 	def add(self, tile):
 		tile.register(len(self.tiles))
 		self.tiles.append(tile)
+		self.tables.clear()
 
 	def add_rotations(self, orig, rotations):
 		for rot in rotations:
 			tile = orig.rotated(rot)
 			tile.register(len(self.tiles))
 			self.tiles.append(tile)
+		self.tables.clear()
+
+	def get_cell_type(self):
+		# dtype, C type and words of a cell, worked out again only when tiles are added
+		if not 'cell_type' in self.tables:
+			for dtype, ctype in cell_types:
+				if len(self.tiles) <= np.dtype(dtype).itemsize * 8:
+					break
+			self.tables['cell_type'] = np.dtype(dtype), ctype, max(1, -(-len(self.tiles) // 64))
+		return self.tables['cell_type']
+
+	@property
+	def words(self):
+		return self.get_cell_type()[2]
+
+	@property
+	def cell_shape(self):
+		return (self.words,) if self.words > 1 else ()
+
+	@property
+	def grid_shape(self):
+		return tuple(self.world_shape) + self.cell_shape
+
+	@property
+	def cell_dtype(self):
+		return self.get_cell_type()[0]
+
+	@property
+	def cell_ctype(self):
+		return self.get_cell_type()[1]
+
+	def get_cell_source(self):
+		# the cell layout and helpers for the kernels, shared by the observers and propagators
+		return '''
+			#ifndef CELL
+			#define CELL {}
+			#define WORDS {}
+			#define CELL_BITS {}
+
+			void load_cell(CELL* bits, __global const CELL* grid, uint i) {{
+				for (uint w = 0; w < WORDS; w++) bits[w] = grid[i * WORDS + w];
+			}}
+
+			void store_cell(__global CELL* grid, uint i, const CELL* bits) {{
+				for (uint w = 0; w < WORDS; w++) grid[i * WORDS + w] = bits[w];
+			}}
+
+			/* only the bit of one tile set */
+			void store_tile(__global CELL* grid, uint i, uint tile) {{
+				for (uint w = 0; w < WORDS; w++) grid[i * WORDS + w] = w == tile / CELL_BITS ? (CELL)1 << (tile % CELL_BITS) : 0;
+			}}
+
+			bool is_empty(__global const CELL* grid, uint i) {{
+				for (uint w = 0; w < WORDS; w++) if (grid[i * WORDS + w]) return false;
+				return true;
+			}}
+
+			/* index of the lowest set bit of a word that isn't 0 */
+			uint lowest_bit(CELL word) {{
+				return popcount((CELL)((word & (CELL)(~word + 1)) - 1));
+			}}
+			#endif
+		'''.format(self.cell_ctype, self.words, self.cell_dtype.itemsize * 8)
+
+	def to_bytes(self, cells):
+		# the bytes of cells, the first one holds the first 8 tiles. shape cells + (bytes,)
+		cells = np.asarray(cells, dtype=self.cell_dtype)
+		if not self.cell_shape:
+			cells = cells[..., np.newaxis]
+		return np.ascontiguousarray(cells, dtype=self.cell_dtype.newbyteorder('<')).view(np.uint8)[..., :(len(self.tiles) + 7) // 8]
+
+	def to_bits(self, cells):
+		# whether each tile is allowed in each cell, shape cells + (tiles,)
+		return np.unpackbits(self.to_bytes(cells), axis=-1, count=len(self.tiles), bitorder='little').astype(bool)
+
+	def from_bits(self, bits):
+		# cells with the tiles that are set along the last axis of bits
+		bits = np.asarray(bits, dtype=bool)
+		padded = np.zeros(bits.shape[:-1] + (self.words * self.cell_dtype.itemsize * 8,), dtype=bool)
+		padded[..., :bits.shape[-1]] = bits
+		packed = np.packbits(padded, axis=-1, bitorder='little')
+		cells = packed.view(self.cell_dtype.newbyteorder('<')).astype(self.cell_dtype)
+		return cells if self.cell_shape else cells[..., 0]
+
+	def to_int(self, cell):
+		# a single cell as an int with a bit for every tile
+		if isinstance(cell, int):
+			return cell
+		if not self.cell_shape:
+			return int(cell)
+		return int.from_bytes(np.asarray(cell, dtype=self.cell_dtype.newbyteorder('<')).tobytes(), 'little')
+
+	def from_int(self, value):
+		if not self.cell_shape:
+			return self.cell_dtype.type(value)
+		data = value.to_bytes(self.words * self.cell_dtype.itemsize, 'little')
+		return np.frombuffer(data, dtype=self.cell_dtype.newbyteorder('<')).astype(self.cell_dtype)
+
+	def differ(self, a, b):
+		# which cells are not the same, over all of their words
+		different = np.asarray(a) != np.asarray(b)
+		return different.any(axis=-1) if self.cell_shape else different
+
+	def get_flags(self):
+		# a cell with only its own tile for every tile
+		return self.from_bits(np.eye(len(self.tiles), dtype=bool))
+
+	def get_all_tiles(self):
+		return self.from_bits(np.ones(len(self.tiles), dtype=bool))
 
 	def build_grid(self):
-		all_tiles = sum(tile.flag for tile in self.tiles)
-		print('filling grid with {}'.format(all_tiles))
-		return np.full(self.world_shape, all_tiles, dtype=cl.cltypes.ulong)
+		return np.full(self.grid_shape, self.get_all_tiles(), dtype=self.cell_dtype)
 
 	def get_allowed_tiles(self, bits):
-		return [tile for tile in self.tiles if tile.flag & bits]
+		bits = self.to_int(bits)
+		return [tile for tile in self.tiles if bits >> tile.index & 1]
+
+	def with_shape(self, world_shape, periodic=True):
+		# the same tiles in a world of a different shape
+		model = type(self)(world_shape, periodic=periodic)
+		for tile in self.tiles:
+			model.add(tile)
+		return model
+
+	def get_neighbours(self, pos):
+		for offset in self.offsets:
+			neighbour = tuple((p + o) % s if wraps else p + o for p, o, s, wraps in zip(pos, offset, self.world_shape, self.wraps))
+			if all(0 <= n < s for n, s in zip(neighbour, self.world_shape)):
+				yield neighbour
+			else:
+				# past the edge of the world a tile is its own neighbour, which the propagators skip
+				yield tuple(pos)
+
+	def get_signature(self):
+		# identifies the tables of this model in the cache
+		if not 'signature' in self.tables:
+			self.tables['signature'] = cache.model_signature(self)
+		return self.tables['signature']
+
+	def get_table(self, name, compute):
+		# memoized, and kept on disk between runs when a cache directory is set
+		if not name in self.tables:
+			self.tables[name] = cache.load_table(self, name, compute)
+		return self.tables[name]
+
+	def get_neighbour_table(self):
+		# flat index of every neighbour of every tile, shape world_shape + (adjacent,)
+		def compute():
+			if self.offsets is None:
+				table = np.zeros(self.world_shape + (self.adjacent,), dtype=np.intp)
+				for pos, _ in np.ndenumerate(table[..., 0]):
+					table[pos] = [np.ravel_multi_index(neighbour, self.world_shape) for neighbour in self.get_neighbours(pos)]
+			else:
+				pos = np.indices(self.world_shape)
+				own = np.arange(int(np.prod(self.world_shape))).reshape(self.world_shape)
+				neighbours = []
+				for offset in self.offsets:
+					neighbour = tuple((p + o) % s if wraps else p + o for p, o, s, wraps in zip(pos, offset, self.world_shape, self.wraps))
+					inside = np.all([(n >= 0) & (n < s) for n, s in zip(neighbour, self.world_shape)], axis=0)
+					neighbours.append(np.where(inside, np.ravel_multi_index(neighbour, self.world_shape, mode='clip'), own))
+				table = np.stack(neighbours, axis=-1)
+			return table
+		return self.get_table('neighbours', compute)
+
+	def get_compatibility(self):
+		# compatible[d, a, b]: tile b may be the neighbour of tile a in direction d
+		adj = np.array([tile.adj for tile in self.tiles])
+		opposite = np.roll(adj, -(adj.shape[1] // 2), axis=1)
+		return adj.T[:, :, np.newaxis] == opposite.T[:, np.newaxis, :]
+
+	def get_allow_table(self, flipped=False):
+		# allowed neighbours of every tile in every direction, shape (tiles, adjacent)
+		def compute():
+			# allowed[a, d, b]: tile b is allowed next to tile a in direction d
+			compatible = self.get_compatibility()
+			allowed = compatible.transpose(2, 0, 1) if flipped else compatible.transpose(1, 0, 2)
+			return np.ascontiguousarray(self.from_bits(allowed))
+		return self.get_table('allows-flipped' if flipped else 'allows', compute)
+
+	def get_fitting(self, neighbours, direction):
+		# tiles that fit in cells whose neighbours in the given direction hold the given bits
+		present = self.to_bits(neighbours).astype(np.int32)
+		compatible = self.get_compatibility()[direction].astype(np.int32)
+		return self.from_bits(present @ compatible.T > 0)
 
 class Model2d(Model):
 	adjacent = 4
+	offsets = ((-1, 0), (0, -1), (1, 0), (0, 1))
 
-	def __init__(self, world_shape):
+	def __init__(self, world_shape, periodic=True):
 		assert len(world_shape) == 2
-		super().__init__(world_shape)
-
-	def get_neighbours(self, pos):
-		w, h = self.world_shape
-		x, y = pos
-		yield (x-1)%w, y
-		yield x, (y-1)%h
-		yield (x+1)%w, y
-		yield x, (y+1)%h
+		super().__init__(world_shape, periodic=periodic)
 
 class Model3d(Model):
 	adjacent = 6
+	offsets = ((-1, 0, 0), (0, -1, 0), (0, 0, -1), (1, 0, 0), (0, 1, 0), (0, 0, 1))
 
-	def __init__(self, world_shape):
+	def __init__(self, world_shape, periodic=True):
 		assert len(world_shape) == 3
-		super().__init__(world_shape)
+		super().__init__(world_shape, periodic=periodic)
 
-	def get_neighbours(self, pos):
-		w, h, d = self.world_shape
-		x, y, z = pos
-		yield (x-1)%w, y, z
-		yield x, (y-1)%h, z
-		yield x, y, (z-1)%d
-		yield (x+1)%w, y, z
-		yield x, (y+1)%h, z
-		yield x, y, (z+1)%d
+def extract_patterns(sample, n=3, symmetry=8, periodic=True):
+	# every n x n window of a 2d array of colour indices (rows along y), with up to 8 rotations and reflections.
+	# returns the distinct patterns indexed (x, y) like the world, and how often each of them occurs
+	grid = np.asarray(sample).T
+	if periodic:
+		grid = np.pad(grid, ((0, n - 1), (0, n - 1)), mode='wrap')
+	positions = (grid.shape[0] - n + 1, grid.shape[1] - n + 1)
+
+	# which cell of the window ends up where, for each rotation and reflection
+	cells = np.arange(n * n).reshape(n, n)
+	transforms = []
+	for k in range(4):
+		rotated = np.rot90(cells, k)
+		transforms += [rotated, rotated[::-1]]
+	transforms = np.stack(transforms[:symmetry]).reshape(-1, n * n)
+
+	# the windows are hashed straight from shifted views of the sample, without copying them out.
+	# keys are exact, split over as many 63 bit words as the number of colours needs
+	colors = int(grid.max()) + 1
+	per_word = max(1, int(63 // np.log2(max(colors, 2))))
+	words = -(-n * n // per_word)
+	keys = np.zeros((len(transforms),) + positions + (words,), dtype=np.int64)
+	for variant, transform in enumerate(transforms):
+		for position, cell in enumerate(transform):
+			i, j = divmod(int(cell), n)
+			word, digit = divmod(position, per_word)
+			keys[variant, ..., word] += grid[i:i + positions[0], j:j + positions[1]].astype(np.int64) * colors ** digit
+
+	keys = keys.reshape(-1, words)
+	if words == 1:
+		_, first, counts = np.unique(keys[:, 0], return_index=True, return_counts=True)
+	else:
+		_, first, counts = np.unique(keys, axis=0, return_index=True, return_counts=True)
+
+	variant, x, y = np.unravel_index(first, (len(transforms),) + positions)
+	windows = np.lib.stride_tricks.sliding_window_view(grid, (n, n))[x, y].reshape(len(first), -1)
+	patterns = np.take_along_axis(windows, transforms[variant], axis=1).reshape(-1, n, n)
+	return patterns, counts
+
+class PatternTile(Tile):
+	# a patch of a sample image, which fits next to the patches it overlaps with consistently
+	def __init__(self, pattern, weight=1, palette=None):
+		super().__init__(None, weight)
+		self.pattern = pattern
+		self.palette = palette
+
+	@property
+	def color(self):
+		# of the cell in the output, which is the first pixel of the pattern
+		if self.palette is None:
+			return None
+		return self.palette[self.pattern[0, 0]]
+
+	@staticmethod
+	def overlap(patterns, direction):
+		# the parts of patterns (..., n, n) that overlap a neighbour in the given direction, and of the neighbour
+		n = patterns.shape[-1]
+		dx, dy = Model2d.offsets[direction]
+		return (patterns[..., max(0, dx):n + min(0, dx), max(0, dy):n + min(0, dy)],
+			patterns[..., max(0, -dx):n + min(0, -dx), max(0, -dy):n + min(0, -dy)])
+
+	def compatible(self, other, direction):
+		ours, _ = self.overlap(self.pattern, direction)
+		_, theirs = self.overlap(other.pattern, direction)
+		return (ours == theirs).all()
+
+class OverlappingModel(Model2d):
+	# the tiles are the n x n patterns of a sample image, weighted by how often they occur in it
+	def __init__(self, world_shape, sample=None, n=3, symmetry=8, periodic=True, periodic_sample=True):
+		super().__init__(world_shape, periodic=periodic)
+		if sample is None:
+			return
+
+		# images (height, width, channels) are turned into colour indices first
+		sample = np.asarray(sample)
+		palette = None
+		if sample.ndim == 3:
+			palette, indices = np.unique(sample.reshape(-1, sample.shape[-1]), axis=0, return_inverse=True)
+			sample = indices.reshape(sample.shape[:2])
+
+		patterns, counts = extract_patterns(sample, n=n, symmetry=symmetry, periodic=periodic_sample)
+		for pattern, count in zip(patterns, counts):
+			self.add(PatternTile(pattern, weight=float(count), palette=palette))
+
+	def get_compatibility(self):
+		# overlaps are compared as whole rows of all patterns at once, identical rows get the same id
+		patterns = np.stack([tile.pattern for tile in self.tiles])
+		count = len(patterns)
+		compatible = []
+		for direction in range(self.adjacent):
+			# the same overlaps PatternTile.compatible compares, for all pairs of tiles
+			ours, theirs = (part.reshape(count, -1) for part in PatternTile.overlap(patterns, direction))
+			ids = np.unique(np.concatenate([ours, theirs]), axis=0, return_inverse=True)[1].reshape(-1)
+			compatible.append(ids[:count, np.newaxis] == ids[np.newaxis, count:])
+		return np.stack(compatible)
@@ -1,67 +1,242 @@
 import pyopencl as cl
 import pyopencl.array
-import pyopencl.clrandom
+import pyopencl.elementwise
 import pyopencl.tools
-import pyopencl.reduction
 import numpy as np
-import numpy.random
+from . import cache
+from .metrics import timed
 
-class CLObserver(object):
-	def __init__(self, model, ctx=None):
+class BaseObserver(object):
+	statuses = ('continue', 'done', 'error')
+	# scale of the random tie-breaking bias added to the entropy
+	noise = 1e-4
+	# instrumentation, set by the runner
+	hooks = None
+
+	def __init__(self, model, blocks=None):
 		self.model = model
-		with cl.CommandQueue(ctx) as queue:
-			self.rnd = pyopencl.clrandom.PhiloxGenerator(ctx)
-			self.bias = cl.array.to_device(queue, np.zeros(self.model.world_shape, dtype=cl.cltypes.float))
+		# bytes moved between host and device while observing
+		self.transferred = 0
 
-			alloc = cl.tools.ImmediateAllocator(queue, cl.mem_flags.READ_ONLY)
-			self.weights_array = np.array(list(tile.weight for tile in self.model.tiles), dtype=cl.cltypes.float)
-			self.weights = cl.array.to_device(queue, self.weights_array, alloc)
+		# optionally collapse one tile in every other block of this shape per step, instead of one per world
+		if isinstance(blocks, int):
+			blocks = (blocks,) * len(self.model.world_shape)
+		self.blocks = blocks
+		if blocks:
+			self.blocks_shape = tuple(-(-size // block) for size, block in zip(self.model.world_shape, blocks))
+		# blocks take turns in 2**dims phases, so the blocks that collapse together never touch
+		self.phase = 0
+
+	def get_active_blocks(self):
+		# every other block along each axis, starting at an offset given by the bits of the phase
+		dims = len(self.blocks_shape)
+		offsets = (self.phase >> np.arange(dims)) & 1
+		self.phase = (self.phase + 1) % (1 << dims)
+		return (np.indices(self.blocks_shape) % 2 == offsets.reshape((-1,) + (1,) * dims)).all(axis=0)
+
+	def get_entropy_table(self):
+		# weight and weight * log(weight) sums for every value of every byte of a bitfield
+		nbytes = (len(self.model.tiles) + 7) // 8
+		weights = np.zeros(nbytes * 8)
+		weights[:len(self.model.tiles)] = [tile.weight for tile in self.model.tiles]
+		weights = weights.reshape(nbytes, 8)
+		weight_logs = weights * np.log(np.where(weights > 0, weights, 1))
+
+		bits = (np.arange(256)[:, np.newaxis] >> np.arange(8)) & 1
+		table = np.zeros(nbytes * 256, dtype=cl.cltypes.float2)
+		table['x'] = (weights @ bits.T).ravel()
+		table['y'] = (weight_logs @ bits.T).ravel()
+		return table
+
+class CPUObserver(BaseObserver):
+	on_device = False
+
+	def __init__(self, model, ctx=None, blocks=None):
+		super().__init__(model, blocks=blocks)
+		self.nbytes = (len(self.model.tiles) + 7) // 8
+		table = self.get_entropy_table()
+		self.entropy_table = np.stack([table['x'], table['y']], axis=-1).astype(np.float64)
+		self.popcounts = ((np.arange(256)[:, np.newaxis] >> np.arange(8)) & 1).sum(axis=1)
+		self.weights = np.array([tile.weight for tile in self.model.tiles])
+		self.flags = self.model.get_flags()
+		# numpy's global random state, until the observer is seeded
+		self.random = np.random
+
+	def seed(self, seed):
+		# a random state of its own, so observers in other threads don't interfere
+		self.random = np.random.RandomState(seed)
+
+	def get_entropy(self, cells):
+		parts = self.model.to_bytes(cells).astype(np.intp)
+		remaining = self.popcounts[parts].sum(axis=1)
+		sums = self.entropy_table[parts + np.arange(self.nbytes) * 256].sum(axis=1)
+
+		with np.errstate(divide='ignore', invalid='ignore'):
+			entropy = np.fmax(np.log(sums[:, 0]) - sums[:, 1] / sums[:, 0], np.finfo(np.float32).eps)
+		entropy[remaining == 1] = -1
+		entropy[remaining == 0] = 0
+		return entropy
+
+	def refresh(self, grid):
+		# entropy is computed from scratch on every observation
+		pass
+
+	def refresh_cell(self, grid, index):
+		pass
+
+	def collapse(self, bits):
+		p = self.weights * self.model.to_bits(bits)
+		tile = self.random.choice(len(p), p=p / np.sum(p))
+		return self.flags[tile]
+
+	def observe(self, grid, single=False):
+		cells = grid.reshape((-1,) + self.model.cell_shape)
+		entropy = self.get_entropy(cells)
+
+		overconstrained = np.flatnonzero(entropy == 0)
+		if len(overconstrained):
+			return ('error', int(overconstrained[0]))
+		elif not (entropy > 0).any():
+			return ('done',)
+
+		# random tie-breaking bias for each tile
+		entropy = np.where(entropy > 0, entropy + self.random.random_sample(len(entropy)) * self.noise, np.inf)
+		if self.blocks and not single:
+			return self.observe_blocks(cells, entropy)
+
+		index = int(np.argmin(entropy))
+		collapsed = timed(self.hooks, 'collapse', self.collapse, cells[index])
+		cells[index] = collapsed
+		return ('continue', index, collapsed if self.model.cell_shape else int(collapsed))
+
+	def observe_blocks(self, cells, entropy):
+		shape = self.model.world_shape
+		dims = len(shape)
+		padded = np.full(tuple(n * size for n, size in zip(self.blocks_shape, self.blocks)), np.inf)
+		padded[tuple(slice(0, size) for size in shape)] = entropy.reshape(shape)
+
+		# lowest entropy in each block, with the blocks along the first axes and their cells flattened
+		split = padded.reshape([dim for pair in zip(self.blocks_shape, self.blocks) for dim in pair])
+		per_block = split.transpose(list(range(0, 2 * dims, 2)) + list(range(1, 2 * dims, 2))).reshape(self.blocks_shape + (-1,))
+		lowest = per_block.argmin(axis=-1)
+		unsolved = np.isfinite(np.take_along_axis(per_block, lowest[..., np.newaxis], axis=-1)[..., 0])
+
+		# skip the phases without any tiles left to collapse
+		for phase in range(1 << len(self.blocks)):
+			active = unsolved & self.get_active_blocks()
+			if active.any():
+				break
+
+		offsets = np.unravel_index(lowest[active], self.blocks)
+		pos = tuple(block * size + offset for block, size, offset in zip(np.nonzero(active), self.blocks, offsets))
+		indices = np.ravel_multi_index(pos, shape)
+		collapse = lambda: np.array([self.collapse(cells[index]) for index in indices], dtype=cells.dtype)
+		collapsed = timed(self.hooks, 'collapse', collapse)
+		cells[indices] = collapsed
+		return ('continue', indices, collapsed)
+
+class CLObserver(BaseObserver):
+	on_device = True
+
+	def __init__(self, model, ctx=None, batch=1, seeds=None, blocks=None):
+		super().__init__(model, blocks=blocks)
+		assert not blocks or batch == 1
+		self.batch = batch
+		self.size = int(np.prod(self.model.world_shape))
+
+		# one reduction group per world for small worlds, more for big ones
+		max_group_size = ctx.devices[0].max_work_group_size
+		self.group_size = 1 << min(8, (self.size - 1).bit_length(), max_group_size.bit_length() - 1)
+		self.groups = max(1, min(self.group_size, self.size // (self.group_size * 4)))
+
+		if seeds is None:
+			seeds = np.random.randint(0, 2**32, size=batch, dtype=cl.cltypes.uint)
+		self.pending_seeds = None
 
 		min_collector = np.dtype([
 			('entropy', cl.cltypes.float),
 			('index', cl.cltypes.uint),
 		])
-		min_collector, min_collector_def = cl.tools.match_dtype_to_c_struct(ctx.devices[0], 'min_collector', min_collector)
+		min_collector, min_collector_def = cache.match_struct(ctx.devices[0], 'min_collector', min_collector)
 		min_collector = cl.tools.get_or_register_dtype('min_collector', min_collector)
 
-		preamble = '''
-			#define STATES {}
-		'''.format(len(self.model.tiles))
+		with cl.CommandQueue(ctx) as queue:
+			self.entropy = cl.array.zeros(queue, (batch * self.size,), dtype=cl.cltypes.float)
+			self.partial = cl.array.empty(queue, (batch * self.groups,), dtype=min_collector)
+			# status, index and collapsed tile + 1 of the last observation of each world
+			self.status = cl.array.zeros(queue, (batch, 3), dtype=cl.cltypes.ulong)
+			# counter-based random streams, one per world
+			self.seeds = cl.array.to_device(queue, np.asarray(seeds, dtype=cl.cltypes.uint))
+			self.steps = cl.array.zeros(queue, (batch,), dtype=cl.cltypes.uint)
+			if blocks:
+				# status, index and collapsed tile + 1 of the last observation of each block
+				self.block_status = cl.array.zeros(queue, (int(np.prod(self.blocks_shape)), 3), dtype=cl.cltypes.ulong)
 
-		self.find_lowest_entropy = cl.reduction.ReductionKernel(ctx,
-			arguments='__global ulong* grid, __global float* bias, __global float* weights',
-			neutral='neutral()',
-			dtype_out=min_collector,
-			map_expr='get_entropy(i, grid[i], bias[i], weights)',
-			reduce_expr='reduce(a, b)',
-			preamble=min_collector_def + preamble + r'''//CL//
+			alloc = cl.tools.ImmediateAllocator(queue, cl.mem_flags.READ_ONLY)
+			self.weights_array = np.array(list(tile.weight for tile in self.model.tiles), dtype=cl.cltypes.float)
+			self.weights = cl.array.to_device(queue, self.weights_array, alloc)
+			self.entropy_table = cl.array.to_device(queue, self.get_entropy_table(), alloc)
+		# what the collapsed tiles in the status stand for
+		self.flags = self.model.get_flags()
 
-			/* start with an imaginary solved tile */
-			min_collector neutral() {
-				min_collector res;
-				res.entropy = -1.0;
-				res.index = 0;
-				return res;
-			}
+		# shared with the propagators, which keep self.entropy up to date
+		self.entropy_source = self.model.get_cell_source() + r'''//CL//
 
-			/* get entropy of tile (> 0)
+			/* shannon entropy of the remaining tiles (> 0)
 			 * -1: solved
 			 *  0: overconstrained */
-			min_collector get_entropy(uint i, ulong bitfield, float bias, __global float* weights) {
-				min_collector res;
-				res.entropy = 0.0f;
-				res.index = i;
-
+			float get_entropy(const CELL* bits, __global const float2* table) {
 				uint remaining_states = 0;
-				for (uint state = 0; state < STATES; state++) {
-					if (bitfield & ((ulong)1 << state)) {
-						remaining_states++;
-						res.entropy += weights[state];
+				for (uint w = 0; w < WORDS; w++) remaining_states += popcount(bits[w]);
+				if (remaining_states == 1) return -1.0f;
+				if (remaining_states == 0) return 0.0f;
+
+				/* sum of weights and weight * log(weight),
+				 * looked up one byte of the bitfield at a time, up to the last one with tiles left */
+				float2 sums = 0.0f;
+				for (uint w = 0; w < WORDS; w++) {
+					CELL word = bits[w];
+					for (uint byte = w * sizeof(CELL); word; byte++, word >>= 8) {
+						uchar part = word;
+						if (part) sums += table[byte * 256 + part];
 					}
 				}
 
-				if (remaining_states == 1) res.entropy = -1.0;
-				else if (remaining_states > 1) res.entropy += bias * 0.5;
+				return fmax(log(sums.x) - sums.y / sums.x, FLT_EPSILON);
+			}
+			'''
+
+		self.update_entropy = cl.elementwise.ElementwiseKernel(ctx,
+			'__global float* entropy, __global {}* grid, __global float2* table'.format(self.model.cell_ctype),
+			'CELL bits[WORDS]; load_cell(bits, grid, i); entropy[i] = get_entropy(bits, table)',
+			preamble=self.entropy_source
+		)
+
+		# shared by the whole-world and the block kernels
+		helpers = min_collector_def + self.model.get_cell_source() + '''
+			#include <pyopencl-random123/philox.cl>
+
+			#define SIZE {}
+			#define GROUP_SIZE {}
+			#define NOISE {}f
+		'''.format(self.size, self.group_size, self.noise) + r'''//CL//
+
+			#define CONTINUE 0
+			#define DONE 1
+			#define ERROR 2
+
+			/* uniform random number in [0, 1) from the world's stream */
+			float get_random(uint seed, uint step, uint i, uint purpose) {
+				philox4x32_key_t k = {{seed, 0}};
+				philox4x32_ctr_t c = {{i, step, purpose, 0}};
+				return (philox4x32(c, k).v[0] >> 8) * (1.0f / 16777216.0f);
+			}
+
+			/* start with an imaginary solved tile */
+			min_collector neutral() {
+				min_collector res;
+				res.entropy = -1.0;
+				res.index = 0;
 				return res;
 			}
 
@@ -72,33 +247,288 @@ class CLObserver(object):
 				if (b.entropy < 0.0) return a;
 				return b.entropy < a.entropy ? b : a;
 			}
+
+			min_collector reduce_group(min_collector res, __local min_collector* scratch) {
+				uint lid = get_local_id(0);
+				scratch[lid] = res;
+				barrier(CLK_LOCAL_MEM_FENCE);
+				for (uint offset = get_local_size(0) / 2; offset > 0; offset >>= 1) {
+					if (lid < offset) scratch[lid] = reduce(scratch[lid], scratch[lid + offset]);
+					barrier(CLK_LOCAL_MEM_FENCE);
+				}
+				return scratch[0];
+			}
+
+			/* one of the remaining states of a tile, chosen randomly according to their weights,
+			 * the last remaining state absorbs rounding errors. only the set bits are visited */
+			uint pick_state(const CELL* bits, __global const float* weights, float random) {
+				float total = 0.0f;
+				for (uint w = 0; w < WORDS; w++) {
+					for (CELL word = bits[w]; word; word &= word - 1)
+						total += weights[w * CELL_BITS + lowest_bit(word)];
+				}
+
+				float pick = random * total;
+				uint state = 0;
+				for (uint w = 0; w < WORDS; w++) {
+					for (CELL word = bits[w]; word; word &= word - 1) {
+						state = w * CELL_BITS + lowest_bit(word);
+						pick -= weights[state];
+						if (pick < 0.0f) return state;
+					}
+				}
+				return state;
+			}
 			'''
+
+		self.program = cl.Program(ctx, helpers + r'''//CL//
+
+			/* first stage: each group reduces a strided part of one world,
+			 * adding a little noise to break ties between unsolved tiles */
+			__kernel void find_lowest_entropy(
+				__global const float* entropy, __global const ulong* status,
+				__global const uint* seeds, __global const uint* steps,
+				__global min_collector* partial
+			) {
+				__local min_collector scratch[GROUP_SIZE];
+				uint world = get_global_id(1);
+
+				min_collector res = neutral();
+				if (status[world * 3] == CONTINUE) {
+					for (uint i = get_global_id(0); i < SIZE; i += get_global_size(0)) {
+						min_collector tile;
+						tile.entropy = entropy[world * SIZE + i];
+						tile.index = i;
+						if (tile.entropy > 0.0f)
+							tile.entropy += get_random(seeds[world], steps[world], i, 0) * NOISE;
+						res = reduce(res, tile);
+					}
+				}
+
+				res = reduce_group(res, scratch);
+				if (get_local_id(0) == 0)
+					partial[world * get_num_groups(0) + get_group_id(0)] = res;
+			}
+
+			/* second stage: one group per world reduces the partial results,
+			 * then collapses the selected tile to one of its remaining states,
+			 * chosen randomly according to their weights */
+			__kernel void collapse(
+				__global const min_collector* partial, const uint groups,
+				__global CELL* grid, __global float* entropy, __global const float* weights,
+				__global ulong* status, __global const uint* seeds, __global uint* steps
+			) {
+				__local min_collector scratch[GROUP_SIZE];
+				uint world = get_global_id(1);
+
+				min_collector res = neutral();
+				for (uint group = get_local_id(0); group < groups; group += GROUP_SIZE)
+					res = reduce(res, partial[world * groups + group]);
+
+				min_collector tile = reduce_group(res, scratch);
+				if (get_local_id(0) != 0 || status[world * 3] != CONTINUE) return;
+
+				__global ulong* world_status = status + world * 3;
+				world_status[1] = tile.index;
+				if (tile.entropy < 0.0f) {
+					world_status[0] = DONE;
+					return;
+				}
+				if (tile.entropy == 0.0f) {
+					world_status[0] = ERROR;
+					return;
+				}
+
+				uint i = world * SIZE + tile.index;
+				CELL bits[WORDS];
+				load_cell(bits, grid, i);
+				uint state = pick_state(bits, weights, get_random(seeds[world], steps[world], 0, 1));
+				steps[world]++;
+
+				store_tile(grid, i, state);
+				entropy[i] = -1.0f;
+				world_status[0] = CONTINUE;
+				world_status[2] = state + 1;
+			}
+			''').build(cache_dir=cache.program_directory())
+
+		if blocks:
+			block_size = int(np.prod(self.blocks))
+			self.block_group_size = 1 << min(8, (block_size - 1).bit_length(), max_group_size.bit_length() - 1)
+			self.block_seed = int(seeds[0])
+			self.block_steps = 0
+
+			self.block_program = cl.Program(ctx, helpers + '''
+				#define DIMS {}
+				#define BLOCK_SIZE {}
+				#define BLOCK_GROUP_SIZE {}
+
+				__constant uint world_shape[] = {{ {} }};
+				__constant uint block_shape[] = {{ {} }};
+				__constant uint blocks_shape[] = {{ {} }};
+			'''.format(
+				len(self.blocks), block_size, self.block_group_size,
+				', '.join(str(size) for size in self.model.world_shape),
+				', '.join(str(size) for size in self.blocks),
+				', '.join(str(size) for size in self.blocks_shape)
+			) + r'''//CL//
+
+				/* index of the i-th tile of a block in the world,
+				 * or SIZE if the block sticks out of the world there */
+				uint block_tile(uint block, uint i) {
+					uint index = 0;
+					uint scale = 1;
+					for (int axis = DIMS - 1; axis >= 0; axis--) {
+						uint pos = block % blocks_shape[axis] * block_shape[axis] + i % block_shape[axis];
+						if (pos >= world_shape[axis]) return SIZE;
+						index += pos * scale;
+						scale *= world_shape[axis];
+						block /= blocks_shape[axis];
+						i /= block_shape[axis];
+					}
+					return index;
+				}
+
+				/* every other block along each axis, starting at an offset given by the bits of the phase */
+				bool block_active(uint block, uint phase) {
+					for (int axis = DIMS - 1; axis >= 0; axis--) {
+						if (block % blocks_shape[axis] % 2 != ((phase >> axis) & 1)) return false;
+						block /= blocks_shape[axis];
+					}
+					return true;
+				}
+
+				/* one group per block finds its tile with the lowest entropy,
+				 * and collapses it if the block takes part in this phase */
+				__kernel void collapse_blocks(
+					__global CELL* grid, __global float* entropy, __global const float* weights,
+					__global ulong* status, const uint seed, const uint step, const uint phase
+				) {
+					__local min_collector scratch[BLOCK_GROUP_SIZE];
+					uint block = get_global_id(1);
+
+					min_collector res = neutral();
+					for (uint i = get_local_id(0); i < BLOCK_SIZE; i += BLOCK_GROUP_SIZE) {
+						uint index = block_tile(block, i);
+						if (index == SIZE) continue;
+
+						min_collector tile;
+						tile.entropy = entropy[index];
+						tile.index = index;
+						if (tile.entropy > 0.0f)
+							tile.entropy += get_random(seed, step, index, 0) * NOISE;
+						res = reduce(res, tile);
+					}
+
+					min_collector tile = reduce_group(res, scratch);
+					if (get_local_id(0) != 0) return;
+
+					__global ulong* block_status = status + block * 3;
+					block_status[1] = tile.index;
+					block_status[2] = 0;
+					if (tile.entropy < 0.0f) {
+						block_status[0] = DONE;
+						return;
+					}
+					if (tile.entropy == 0.0f) {
+						block_status[0] = ERROR;
+						return;
+					}
+
+					block_status[0] = CONTINUE;
+					if (!block_active(block, phase)) return;
+
+					CELL bits[WORDS];
+					load_cell(bits, grid, tile.index);
+					uint state = pick_state(bits, weights, get_random(seed, step, block, 1));
+					store_tile(grid, tile.index, state);
+					entropy[tile.index] = -1.0f;
+					block_status[2] = state + 1;
+				}
+				''').build(cache_dir=cache.program_directory())
+
+	def seed(self, seed):
+		# the random streams restart from these seeds on the next refresh
+		self.pending_seeds = (seed + np.arange(self.batch)).astype(cl.cltypes.uint)
+
+	def refresh(self, grid):
+		if self.pending_seeds is not None:
+			self.seeds.set(self.pending_seeds, queue=grid.queue)
+			self.steps.fill(0, queue=grid.queue)
+			self.transferred += self.pending_seeds.nbytes
+			if self.blocks:
+				self.block_seed = int(self.pending_seeds[0])
+				self.block_steps = 0
+			self.pending_seeds = None
+
+		# recompute all entropies and start observing every world again
+		self.update_entropy(self.entropy, grid, self.entropy_table, queue=grid.queue)
+		self.status.fill(0, queue=grid.queue)
+
+	def refresh_cell(self, grid, index):
+		# after a cell was written from the host, flat index across all worlds
+		self.update_entropy(self.entropy, grid, self.entropy_table, queue=grid.queue, range=slice(index, index + 1))
+
+	def observe_all(self, grid):
+		queue = grid.queue
+		event = self.program.find_lowest_entropy(
+			queue, (self.groups * self.group_size, self.batch), (self.group_size, 1),
+			self.entropy.data, self.status.data,
+			self.seeds.data, self.steps.data,
+			self.partial.data
 		)
+		if self.hooks:
+			self.hooks.kernel('find_lowest_entropy', event)
+		event = self.program.collapse(
+			queue, (self.group_size, self.batch), (self.group_size, 1),
+			self.partial.data, np.uint32(self.groups),
+			grid.data, self.entropy.data, self.weights.data,
+			self.status.data, self.seeds.data, self.steps.data
+		)
+		if self.hooks:
+			self.hooks.kernel('collapse', event)
+		status = self.status.get(queue=queue)
+		self.transferred += status.nbytes
+		return status
 
-	def collapse(self, bits):
-		p = self.weights_array.copy()
-		bits = int(bits.get())
-		for i in range(len(p)):
-			p[i] *= not not bits & (1 << i)
-		p = p / np.sum(p)
-		tile = np.random.choice(self.model.tiles, p=p)
-		print('collapsing from {} to {}'.format(bits, tile.flag))
-		return tile.flag
-
-	def observe(self, grid):
-		# random tie-breaking bias for each tile
-		self.rnd.fill_uniform(self.bias)
+	def observe_blocks(self, grid):
+		queue = grid.queue
+		blocks = len(self.block_status)
+		# skip the phases without any tiles left to collapse
+		for phase in range(1 << len(self.blocks)):
+			event = self.block_program.collapse_blocks(
+				queue, (self.block_group_size, blocks), (self.block_group_size, 1),
+				grid.data, self.entropy.data, self.weights.data,
+				self.block_status.data, np.uint32(self.block_seed), np.uint32(self.block_steps), np.uint32(self.phase)
+			)
+			if self.hooks:
+				self.hooks.kernel('collapse_blocks', event)
+			self.phase = (self.phase + 1) % (1 << len(self.blocks))
+			self.block_steps += 1
 
-		tile = self.find_lowest_entropy(grid, self.bias, self.weights).get()
-		entropy, index = tile['entropy'].item(), tile['index'].item()
+			status = self.block_status.get(queue=queue)
+			self.transferred += status.nbytes
+			errors = np.flatnonzero(status[:, 0] == 2)
+			if (status[:, 2] != 0).any() or len(errors) or (status[:, 0] == 1).all():
+				break
 
-		t_index = np.unravel_index(index, self.model.world_shape)
-		if entropy < 0:
-			print('solved!')
+		if len(errors):
+			return ('error', int(status[errors[0], 1]))
+		elif (status[:, 0] == 1).all():
 			return ('done',)
-		elif entropy == 0:
-			print('tile {} overconstrained!'.format(t_index))
-			return ('error',)
 
-		print('selected tile {} with entropy {}'.format(t_index, entropy))
-		return ('continue', index, self.collapse(grid[t_index]))
+		collapsed = status[status[:, 2] != 0]
+		return ('continue', collapsed[:, 1].astype(int), self.flags[collapsed[:, 2].astype(int) - 1])
+
+	def observe(self, grid, single=False):
+		if self.blocks and not single:
+			return self.observe_blocks(grid)
+
+		status, index, collapsed = self.observe_all(grid)[0].tolist()
+
+		if self.statuses[status] == 'done':
+			return ('done',)
+		elif self.statuses[status] == 'error':
+			return ('error', index)
+		collapsed = self.flags[collapsed - 1]
+		return ('continue', index, collapsed if self.model.cell_shape else int(collapsed))
@@ -1,8 +1,9 @@
-from numpy import ndenumerate
+import numpy as np
 from pyglet.app import run
 from pyglet.window import Window, key
 from pyglet.resource import image
 from pyglet.image import get_buffer_manager
+from pyglet.graphics import Batch
 from pyglet.text import Label
 from pyglet.sprite import Sprite
 
@@ -12,11 +13,54 @@ class BasePreview(Window):
 		self.runner = runner
 		self.debug = False
 
+		# sprites (and debug labels) of each cell, only rebuilt when the bits of that cell change
+		self.batch = Batch()
+		self.sprites = {}
+		self.labels = {}
+		self.drawn = None
+		self.allowed = {}
+
+	def get_grid(self):
+		return self.runner.grid_array
+
+	def get_allowed_tiles(self, bits):
+		if not bits in self.allowed:
+			self.allowed[bits] = self.runner.model.get_allowed_tiles(bits)
+		return self.allowed[bits]
+
+	def invalidate(self):
+		# rebuild every cell on the next frame
+		self.drawn = None
+
+	def update_cell(self, pos, bits):
+		for sprite in self.sprites.pop(pos, []):
+			sprite.delete()
+		if pos in self.labels:
+			self.labels.pop(pos).delete()
+
+		if bits == 0:
+			return
+		self.sprites[pos] = self.make_sprites(pos, bits)
+		if self.debug:
+			x, y = self.get_center(pos)
+			self.labels[pos] = Label(str(bits), x=x, y=y, batch=self.batch)
+
 	def on_draw(self):
 		self.clear()
+		# the runner only reads the grid back from the device when asked to
+		self.runner.fetch()
+
+		model = self.runner.model
+		grid = self.get_grid()
+		if self.drawn is None:
+			changed = np.ndindex(grid.shape[:grid.ndim - len(model.cell_shape)])
+		else:
+			changed = zip(*(axis.tolist() for axis in np.nonzero(model.differ(grid, self.drawn))))
+		for pos in changed:
+			self.update_cell(pos, model.to_int(grid[pos]))
+		self.drawn = grid.copy()
 
-		for pos, bits in ndenumerate(self.runner.grid_array):
-			self.draw_tiles(pos, bits)
+		self.batch.draw()
 
 	def on_key_press(self, symbol, modifiers):
 		if symbol == key.ESCAPE:
@@ -27,6 +71,7 @@ class BasePreview(Window):
 			self.runner.finish()
 		elif symbol == key.D:
 			self.debug = not self.debug
+			self.invalidate()
 
 	def screenshot(self, name='shots/snapshot.png'):
 		get_buffer_manager().get_color_buffer().save(name)
@@ -54,32 +99,30 @@ class PreviewWindow(BasePreview):
 	def __init__(self, runner):
 		super().__init__(runner, width=512, height=512)
 
-		tile = image('tile.png')
-		tile.anchor_x = 32
-		tile.anchor_y = 32
-		self.sprite = Sprite(img=tile, x=0, y=0)
-
-	def draw_tiles(self, pos, bits):
-		if bits == 0:
-			return
+		self.tile = image('tile.png')
+		self.tile.anchor_x = 32
+		self.tile.anchor_y = 32
 
+	def get_center(self, pos):
 		x, y = pos[-2:]
-		self.sprite.x = x * 64 + 32
-		self.sprite.y = self.height - y * 64 - 32
+		return x * 64 + 32, self.height - y * 64 - 32
 
-		tiles = self.runner.model.get_allowed_tiles(bits)
-		self.sprite.opacity = 255 / len(tiles)
+	def make_sprites(self, pos, bits):
+		x, y = self.get_center(pos)
+		tiles = self.get_allowed_tiles(bits)
+		opacity = int(255 / len(tiles))
 
+		sprites = []
 		for tile in tiles:
 			for direction, adj in enumerate(tile.adj):
 				if adj < 1 or self.rotations[direction] == None:
 					continue
-				self.sprite.color = self.colors[adj]
-				self.sprite.rotation = self.rotations[direction] 
-				self.sprite.draw()
-
-		if self.debug:
-			Label(str(bits), x=self.sprite.x, y=self.sprite.y).draw()
+				sprite = Sprite(img=self.tile, x=x, y=y, batch=self.batch)
+				sprite.color = self.colors[adj]
+				sprite.opacity = opacity
+				sprite.rotation = self.rotations[direction]
+				sprites.append(sprite)
+		return sprites
 
 class PreviewWindow3d(PreviewWindow):
 	rotations = [0, 90, None, 180, 270, None]
@@ -88,11 +131,8 @@ class PreviewWindow3d(PreviewWindow):
 		super().__init__(*args)
 		self.slice = 0
 
-	def on_draw(self):
-		self.clear()
-
-		for pos, bits in ndenumerate(self.runner.grid_array[...,self.slice]):
-			self.draw_tiles(pos, bits)
+	def get_grid(self):
+		return self.runner.grid_array[:, :, self.slice]
 
 	def on_key_press(self, symbol, modifiers):
 		if symbol == key.UP:
@@ -103,6 +143,7 @@ class PreviewWindow3d(PreviewWindow):
 			super().on_key_press(symbol, modifiers)
 			return
 		self.slice = self.slice % self.runner.model.world_shape[-1]
+		self.invalidate()
 		print(self.slice)
 
 class SpritePreviewWindow(BasePreview):
@@ -111,26 +152,24 @@ class SpritePreviewWindow(BasePreview):
 		height = runner.model.world_shape[1] * tile_size
 		super().__init__(runner, width=width, height=height)
 
-		self.sprite = Sprite(img=runner.model.tiles[0].image)
 		self.tile_size = tile_size
+		for tile in runner.model.tiles:
+			tile.image.anchor_x = self.tile_size/2
+			tile.image.anchor_y = self.tile_size/2
 
-	def draw_tiles(self, pos, bits):
-		if bits == 0:
-			return
-
+	def get_center(self, pos):
 		x, y = pos[-2:]
-		self.sprite.x = x * self.tile_size + self.tile_size/2
-		self.sprite.y = self.height - y * self.tile_size - self.tile_size/2
+		return x * self.tile_size + self.tile_size/2, self.height - y * self.tile_size - self.tile_size/2
 
-		tiles = self.runner.model.get_allowed_tiles(bits)
-		self.sprite.opacity = 255 / len(tiles)
+	def make_sprites(self, pos, bits):
+		x, y = self.get_center(pos)
+		tiles = self.get_allowed_tiles(bits)
+		opacity = int(255 / len(tiles))
 
+		sprites = []
 		for tile in tiles:
-			tile.image.anchor_x = self.tile_size/2
-			tile.image.anchor_y = self.tile_size/2
-			self.sprite.image = tile.image
-			self.sprite.rotation = tile.rotation * 90
-			self.sprite.draw()
-
-		if self.debug:
-			Label(str(bits), x=self.sprite.x, y=self.sprite.y).draw()
+			sprite = Sprite(img=tile.image, x=x, y=y, batch=self.batch)
+			sprite.opacity = opacity
+			sprite.rotation = tile.rotation * 90
+			sprites.append(sprite)
+		return sprites
@@ -4,52 +4,46 @@ import pyopencl.cltypes
 import pyopencl.tools
 import pyopencl.reduction
 import numpy as np
+from . import cache
 
 class BasePropagator(object):
+	# instrumentation, set by the runner
+	hooks = None
+
 	def __init__(self, model):
 		self.model = model
+		# bytes moved between host and device while propagating
+		self.transferred = 0
 
 	def get_neighbours(self, pad_to=None):
 		if not pad_to:
 			pad_to = self.model.adjacent
-		diff = pad_to - self.model.adjacent
 
 		neighbours = np.zeros(self.model.world_shape + (pad_to,), dtype=cl.cltypes.uint)
-		for pos, _ in np.ndenumerate(neighbours[...,0]):
-			neighbours[pos] = [np.ravel_multi_index(neighbour, self.model.world_shape) for neighbour in self.model.get_neighbours(pos)] + [0] * diff
+		neighbours[..., :self.model.adjacent] = self.model.get_neighbour_table()
 		return neighbours
 
 	def get_allows(self, pad_to=None, flipped=False):
 		if not pad_to:
 			pad_to = self.model.adjacent
 
-		def add_allows(i, direction):
-			if direction >= self.model.adjacent:
-				return 0
-			ret = np.uint64(0)
-			tile = self.model.tiles[i]
-			for other in self.model.tiles:
-				if tile.compatible(other, direction):
-					ret |= other.flag
-			return ret
-
-		if flipped:
-			def add_allows(i, direction):
-				if direction >= self.model.adjacent:
-					return 0
-
-				ret = np.uint64(0)
-				tile = self.model.tiles[i]
-				for other in self.model.tiles:
-					if other.compatible(tile, direction):
-						ret |= other.flag
-				return ret
-
-		return np.fromfunction(
-			np.vectorize(add_allows),
-			(len(self.model.tiles), pad_to),
-			dtype=int
-		).astype(cl.cltypes.ulong)
+		allows = np.zeros((len(self.model.tiles), pad_to) + self.model.cell_shape, dtype=self.model.cell_dtype)
+		allows[:, :self.model.adjacent] = self.model.get_allow_table(flipped=flipped)
+		return allows
+
+	def get_allow_tables(self, flipped=False):
+		# union of the allows of all tiles in each value of each byte of a bitfield
+		allows = self.get_allows(flipped=flipped)
+		nbytes = (len(self.model.tiles) + 7) // 8
+		padded = np.zeros((nbytes * 8,) + allows.shape[1:], dtype=allows.dtype)
+		padded[:len(allows)] = allows
+		padded = padded.reshape((nbytes, 8) + allows.shape[1:])
+
+		tables = np.zeros((nbytes, 256) + allows.shape[1:], dtype=allows.dtype)
+		for bit in range(8):
+			values = (np.arange(256) >> bit) & 1 == 1
+			tables[:, values] |= padded[:, bit, np.newaxis]
+		return tables
 
 	def get_config(self):
 		adj = self.model.adjacent
@@ -60,7 +54,8 @@ class BasePropagator(object):
 			'adj': adj,
 			'adj_pow': adjacent_pow,
 			'adj_uint': 'uint' + str(adjacent_pow),
-			'adj_ulong': 'ulong' + str(adjacent_pow),
+			'cell': self.model.cell_ctype,
+			'adj_cell': self.model.cell_ctype + str(adjacent_pow),
 			'states': len(self.model.tiles),
 			'forNeighbour': lambda tpl, join='\n': join.join([tpl.format(i=i) for i in range(adj)]),
 		}
@@ -68,47 +63,238 @@ class BasePropagator(object):
 		config['preamble'] = '''
 			#define ADJ {adj}
 			#define ADJUINT {adj_uint}
-			#define ADJULONG {adj_ulong}
+			#define ADJCELL {adj_cell}
 			#define STATES {states}
-		'''.format(**config)
+		'''.format(**config) + self.model.get_cell_source()
 
 		return config
 
-class CPUPropagator(BasePropagator):
-	def __init__(self, model, ctx=None):
+class HostPropagator(BasePropagator):
+	def __init__(self, model, ctx=None, observer=None):
 		super().__init__(model)
-		self.allows = self.get_allows()
-
-	def reduce_to_allowed(self, i, allowmap, grid):
-		old = grid[i]
-		new = old & allowmap
-		# print('tile {}: {} & {} = {}, delta: {}'.format(i, old, allowmap, new, diff))
-		if old == new or not new:
-			return
-		grid[i] = new
-
-		allowmaps = np.zeros((4,), dtype=np.uint64)
-		for tile in self.model.tiles:
-			if new & tile.flag:
-				# print('delta bit {}, propagate allows {}'.format(tile.index, self.allows[tile.index]))
-				allowmaps |= self.allows[tile.index]
-		# print('neighbour allows: {}'.format(allowmaps))
-
-		for n, neighbour in enumerate(self.model.get_neighbours(i)):
-			self.reduce_to_allowed(
-				neighbour,
-				allowmaps[n],
-				grid
-			)
-
-	def propagate(self, grid, index, collapsed):
-		self.reduce_to_allowed(np.unravel_index(index, self.model.world_shape), np.uint64(collapsed), grid)
+		self.observer = observer
+		self.turns = 0
+
+	def propagate_cells(self, grid, indices):
+		# the cells are already collapsed
+		if isinstance(grid, cl.array.Array):
+			# works on the device grid too, but transfers it twice
+			host_grid = grid.get()
+			self.turns = self.reduce_to_allowed(host_grid.reshape((-1,) + self.model.cell_shape), indices)
+			grid.set(host_grid)
+			self.transferred += 2 * host_grid.nbytes
+		else:
+			self.turns = self.reduce_to_allowed(grid.reshape((-1,) + self.model.cell_shape), indices)
+
+		if self.observer:
+			self.observer.refresh(grid)
+		return self.turns
+
+	def propagate(self, grid, index, collapsed, observed=True):
+		# cells collapsed by the observer are in the grid already, others (e.g. after backtracking) are written here
+		if not observed:
+			grid[np.unravel_index(index, self.model.world_shape)] = collapsed
+		return self.propagate_cells(grid, [index])
+
+class CPUPropagator(HostPropagator):
+	def __init__(self, model, ctx=None, observer=None):
+		super().__init__(model, ctx=ctx, observer=observer)
+
+		# plain python lists and ints are a lot faster to index than numpy arrays,
+		# and ints have as many bits as there are tiles
+		self.neighbours = self.get_neighbours().reshape(-1, self.model.adjacent).tolist()
+		self.allow_tables = [
+			[tuple(self.model.to_int(allow) for allow in allows) for allows in table]
+			for table in self.get_allow_tables()
+		]
+
+	def get_allowmaps(self, bits):
+		allowmaps = [0] * self.model.adjacent
+		for table in self.allow_tables:
+			if bits & 0xff:
+				allowmaps = [a | b for a, b in zip(allowmaps, table[bits & 0xff])]
+			bits >>= 8
+		return allowmaps
+
+	def reduce_to_allowed(self, cells, indices):
+		to_int, from_int = self.model.to_int, self.model.from_int
+		turns = 0
+		worklist = list(indices)
+		while worklist:
+			i = worklist.pop()
+			allowmaps = self.get_allowmaps(to_int(cells[i]))
+			for neighbour, allowmap in zip(self.neighbours[i], allowmaps):
+				if neighbour == i:
+					# the edge of a world that doesn't wrap around
+					continue
+				old = to_int(cells[neighbour])
+				new = old & allowmap
+				if old == new:
+					continue
+				cells[neighbour] = from_int(new)
+				# overconstrained tiles are left for the observer
+				if new:
+					worklist.append(neighbour)
+			turns += 1
+		return turns
+
+class AC4Propagator(HostPropagator):
+	def __init__(self, model, ctx=None, observer=None):
+		super().__init__(model, ctx=ctx, observer=observer)
+		states, adj = len(self.model.tiles), self.model.adjacent
+
+		neighbours = self.get_neighbours().reshape(-1, adj)
+		self.neighbours = neighbours.tolist()
+		# the cell that has each cell as its neighbour in each direction,
+		# or -1 past the edge of a world that doesn't wrap around
+		cells = np.arange(len(neighbours))
+		self.sources = np.full(neighbours.shape, -1, dtype=np.intp)
+		for direction in range(adj):
+			inside = neighbours[:, direction] != cells
+			self.sources[neighbours[inside, direction], direction] = cells[inside]
+
+		# supports[direction, a, b]: tile a in a cell allows tile b in its neighbour
+		self.flags = self.model.get_flags()
+		self.supports = self.model.to_bits(self.get_allows()).transpose(1, 0, 2)
+		self.supported = [
+			[np.flatnonzero(self.supports[direction, tile]) for direction in range(adj)]
+			for tile in range(states)
+		]
+		self.support_counts = self.supports.astype(np.int16)
+
+		# the grid the support counts were last brought up to date with
+		self.known = None
+
+	def count_supports(self, cells):
+		tiles = self.model.to_bits(cells).astype(np.int16)
+		counts = np.empty((len(cells), len(self.flags), self.model.adjacent), dtype=np.int16)
+		for direction, supports in enumerate(self.supports):
+			counts[..., direction] = tiles[self.sources[:, direction]] @ supports.astype(np.int16)
+			# nothing past the edge can withdraw its support
+			counts[self.sources[:, direction] < 0, :, direction] = len(self.flags)
+		return counts
+
+	def reduce_to_allowed(self, cells, indices):
+		# the tiles of each cell as booleans while propagating, written back to the cells that changed at the end
+		present = self.model.to_bits(cells)
+		changed = set()
+		# cells with the tiles they lost, whose supports were not withdrawn yet
+		removed = []
+		if self.known is None or (cells & ~self.known).any():
+			# tiles were added back (e.g. when backtracking), count from scratch
+			self.counts = self.count_supports(cells)
+			unsupported = present & (self.counts == 0).any(axis=-1)
+			present &= ~unsupported
+			losing, lost = np.flatnonzero(unsupported.any(axis=-1)), unsupported
+			changed.update(losing.tolist())
+		else:
+			losing = np.flatnonzero(self.model.differ(cells, self.known))
+			lost = self.model.to_bits(self.known) & ~present
+		removed = [(cell, np.flatnonzero(lost[cell])) for cell in losing.tolist()]
+
+		turns = 0
+		while removed:
+			cell, tiles = removed.pop()
+			turns += len(tiles)
+			for direction, neighbour in enumerate(self.neighbours[cell]):
+				if neighbour == cell:
+					continue
+				# the supports of all the tiles the cell lost are withdrawn at once
+				counts = self.counts[neighbour, :, direction]
+				if len(tiles) == 1:
+					counts[self.supported[tiles[0]][direction]] -= 1
+				else:
+					counts -= self.support_counts[direction, tiles].sum(axis=0, dtype=np.int16)
+
+				# and every tile of the neighbour that lost its last support is banned at once
+				banned = present[neighbour] & (counts <= 0)
+				if not banned.any():
+					continue
+				present[neighbour] &= ~banned
+				changed.add(neighbour)
+				if not present[neighbour].any():
+					# overconstrained tiles are left for the observer,
+					# the counts will be rebuilt on the next call
+					self.write_back(cells, present, changed)
+					self.known = None
+					return turns
+				removed.append((neighbour, np.flatnonzero(banned)))
+
+		self.write_back(cells, present, changed)
+		self.known = cells.copy()
+		return turns
+
+	def write_back(self, cells, present, changed):
+		changed = sorted(changed)
+		if changed:
+			cells[changed] = self.model.from_bits(present[changed])
+
+class NumpyPropagator(HostPropagator):
+	def __init__(self, model, ctx=None, observer=None):
+		super().__init__(model, ctx=ctx, observer=observer)
+
+		# each direction is a fixed offset, measured from the center of the world
+		center = tuple(size // 2 for size in self.model.world_shape)
+		self.shifts = [
+			tuple((n - c + s // 2) % s - s // 2 for n, c, s in zip(neighbour, center, self.model.world_shape))
+			for neighbour in self.model.get_neighbours(center)
+		]
+		self.axes = tuple(range(len(self.model.world_shape)))
+
+		# per byte and direction, so looking up the bytes of the grid gives one allowmap per direction
+		self.allow_tables = np.moveaxis(self.get_allow_tables(), 2, 1)
+		self.all_tiles = self.model.get_all_tiles()
+
+	def get_allowmaps(self, grid):
+		parts = self.model.to_bytes(grid)
+		allowmaps = np.zeros((self.model.adjacent,) + grid.shape, dtype=grid.dtype)
+		for byte, table in enumerate(self.allow_tables):
+			allowmaps |= table[:, parts[..., byte]]
+		# overconstrained tiles are left for the observer, instead of flooding the world
+		allowmaps[:, (parts == 0).all(axis=-1)] = self.all_tiles
+		return allowmaps
+
+	def shift(self, allowmap, shift):
+		if all(self.model.wraps):
+			return np.roll(allowmap, shift, axis=self.axes)
+
+		for axis, (s, wraps) in enumerate(zip(shift, self.model.wraps)):
+			if not s:
+				continue
+			if wraps:
+				allowmap = np.roll(allowmap, s, axis=axis)
+				continue
+
+			# past the edge of the world everything is allowed
+			shifted = np.full_like(allowmap, self.all_tiles)
+			target, source = [slice(None)] * allowmap.ndim, [slice(None)] * allowmap.ndim
+			target[axis] = slice(max(0, s), allowmap.shape[axis] + min(0, s))
+			source[axis] = slice(max(0, -s), allowmap.shape[axis] + min(0, -s))
+			shifted[tuple(target)] = allowmap[tuple(source)]
+			allowmap = shifted
+		return allowmap
+
+	def reduce_to_allowed(self, cells, indices):
+		grid = cells.reshape(self.model.grid_shape)
+		turns = 0
+		while True:
+			allowmaps = self.get_allowmaps(grid)
+			new = grid.copy()
+			for direction, shift in enumerate(self.shifts):
+				if any(shift):
+					new &= self.shift(allowmaps[direction], shift)
+			turns += 1
+
+			if np.array_equal(new, grid):
+				return turns
+			grid[...] = new
 
 class CL2Propagator(BasePropagator):
-	def __init__(self, model, ctx=None):
+	def __init__(self, model, ctx=None, observer=None):
 		super().__init__(model)
 
 		self.ctx = ctx
+		self.observer = observer
 
 		with cl.CommandQueue(ctx) as queue:
 			alloc = cl.tools.ImmediateAllocator(queue, cl.mem_flags.READ_ONLY)
@@ -118,16 +304,16 @@ class CL2Propagator(BasePropagator):
 		config = self.get_config()
 		self.program = cl.Program(ctx, config['preamble'] + '''
 		__kernel void reduce_to_allowed(
-			const uint i, const ulong allowmap,
-			__global ulong* grid, __global ADJULONG* allows, __global ADJUINT* neighbours
+			const uint i, const CELL allowmap,
+			__global CELL* grid, __global ADJCELL* allows, __global ADJUINT* neighbours
 		) {
-			ulong old_bits = grid[i];
-			ulong new_bits = old_bits & allowmap;
+			CELL old_bits = grid[i];
+			CELL new_bits = old_bits & allowmap;
 			grid[i] = new_bits;
-			ulong diff = old_bits ^ new_bits;
+			CELL diff = old_bits ^ new_bits;
 			if (!diff) return;
 
-			ADJULONG allowmaps;
+			ADJCELL allowmaps;
 			for (int bit = 0; bit < STATES; bit++) {
 				if (new & (1 << i))
 					allowmaps |= allows[bit];
@@ -140,7 +326,7 @@ class CL2Propagator(BasePropagator):
 				ndrange_1D(ADJ),
 				^{
 					uint neighbour = get_global_id(0);
-					ulong allow = allowmaps[neighbour];
+					CELL allow = allowmaps[neighbour];
 					reduce_to_allowed(
 						neighbours[i][neighbour], allow,
 						grid, allows, neighbours
@@ -148,65 +334,408 @@ class CL2Propagator(BasePropagator):
 				}
 			);
 		}
-		''').build()
+		''').build(cache_dir=cache.program_directory())
 
-	def propagate(self, grid, index, collapsed):
+	def propagate(self, grid, index, collapsed, observed=True):
 		with cl.CommandQueue(self.ctx) as queue:
 			self.program.reduce_to_allowed(
 				queue, (1,), None,
 				index, collapsed,
 				grid, self.allows_buf, self.neighbours_buf
 			)
+		if self.observer:
+			self.observer.refresh(grid)
 
 class CL1Propagator(BasePropagator):
-	def __init__(self, model, ctx=None):
+	# shared by the per-tile and the tiled kernels
+	mask_source = '''
+		/* removes what none of the remaining tiles of a neighbour allow in this direction,
+		 * visiting only their set bits, so words without tiles left cost nothing */
+		void apply_mask(CELL* bits, const CELL* neighbour, uint direction, __global const CELL* allows) {
+			CELL mask[WORDS];
+			for (uint w = 0; w < WORDS; w++) mask[w] = 0;
+			for (uint n = 0; n < WORDS; n++) {
+				for (CELL word = neighbour[n]; word; word &= word - 1) {
+					__global const CELL* allowed = allows + ((n * CELL_BITS + lowest_bit(word)) * ADJ + direction) * WORDS;
+					for (uint w = 0; w < WORDS; w++) mask[w] |= allowed[w];
+				}
+			}
+			for (uint w = 0; w < WORDS; w++) bits[w] &= mask[w];
+		}
+	'''
+
+	def __init__(self, model, ctx=None, observer=None, batch=1, frontier=False, sync_every=8, tiled=False, block=None):
 		super().__init__(model)
+		assert not (frontier and tiled)
+		self.observer = observer
+		self.batch = batch
+		self.frontier = frontier
+		self.tiled = tiled
+		self.sync_every = sync_every
+		self.turns = 0
 
 		config = self.get_config()
+		self.size = int(np.prod(self.model.world_shape))
+		# worlds are stacked along the first axis of the grid
+		cells = batch * self.size
 
 		with cl.CommandQueue(ctx) as queue:
 			alloc = cl.tools.ImmediateAllocator(queue, cl.mem_flags.READ_ONLY)
-			self.allows_buf = cl.array.to_device(queue, self.get_allows(pad_to=config['adj_pow'], flipped=True), alloc)
+			# the words of what each tile allows in each direction, one after the other
+			self.allows_buf = cl.array.to_device(queue, self.get_allows(flipped=True).reshape(-1), alloc)
 			self.neighbours_buf = cl.array.to_device(queue, self.get_neighbours(pad_to=config['adj_pow']), alloc)
 
+			# whether anything changed, for each turn between two syncs
+			self.changes = cl.array.zeros(queue, (sync_every,), cl.cltypes.uint)
+
+			if frontier:
+				# double-buffered list of the cells that changed in the last turn
+				self.frontiers = [cl.array.empty(queue, (cells,), cl.cltypes.uint) for i in range(2)]
+				# length of the frontier at the start of each turn between two syncs
+				self.frontier_sizes = cl.array.zeros(queue, (sync_every + 1,), cl.cltypes.uint)
+				# turn stamp of the last evaluation, so each cell is claimed once per turn
+				self.claimed = cl.array.zeros(queue, (cells,), cl.cltypes.uint)
+				self.stamp = 0
+
 		fN = config['forNeighbour']
 
-		self.update_grid = cl.reduction.ReductionKernel(ctx,
-			arguments='__global ulong* grid, __global {adj_ulong}* allows, __global {adj_uint}* neighbours'.format(**config),
-			neutral='0',
-			dtype_out=cl.cltypes.uint,
-			map_expr='update_tile(i, grid, allows, neighbours)',
-			reduce_expr='a + b',
-			preamble=config['preamble'] + '''
-			uint update_tile(uint i, __global ulong* grid, __global ADJULONG* allows, __global ADJUINT* neighbours) {
-				ulong old_bits = grid[i];
-
-				ADJUINT next = neighbours[i];
-				''' +
-				fN('''
-					ulong grid_{i} = grid[next.s{i}];
-					ulong mask_{i} = 0;
+		# keep the observer's entropy up to date for every tile that changes
+		if observer:
+			self.entropy_args = [observer.entropy.data, observer.entropy_table.data]
+			entropy = observer.entropy_source + '''
+			#define ENTROPY_ARGS , __global float* entropy, __global const float2* entropy_table
+			#define ENTROPY_PASS , entropy, entropy_table
+			#define UPDATE_ENTROPY(i, bits) entropy[i] = get_entropy(bits, entropy_table)
+			'''
+		else:
+			self.entropy_args = []
+			entropy = '''
+			#define ENTROPY_ARGS
+			#define ENTROPY_PASS
+			#define UPDATE_ENTROPY(i, bits)
+			'''
+
+		self.program = cl.Program(ctx, config['preamble'] + entropy + self.mask_source + '''
+			#define SIZE {}
+		'''.format(self.size) + '''
+			/* neighbours of a tile, in the same world */
+			ADJUINT get_neighbours(uint i, __global ADJUINT* neighbours) {
+				return neighbours[i % SIZE] + (i / SIZE) * SIZE;
+			}
+
+			uint update_tile(
+				uint i,
+				__global CELL* grid, __global const CELL* allows, __global ADJUINT* neighbours
+				ENTROPY_ARGS
+			) {
+				CELL old_bits[WORDS], new_bits[WORDS], neighbour[WORDS];
+				load_cell(old_bits, grid, i);
+				for (uint w = 0; w < WORDS; w++) new_bits[w] = old_bits[w];
+
+				/* past the edge of a world that doesn't wrap around a tile is its own neighbour */
+				ADJUINT next = get_neighbours(i, neighbours);
+				''' + fN('''
+				if (next.s{i} != i) {{
+					load_cell(neighbour, grid, next.s{i});
+					apply_mask(new_bits, neighbour, {i}, allows);
+				}}
 				''') + '''
 
-				for (uint tile = 0; tile < STATES; tile++) {
-					ulong flag = 1 << tile;
-					ADJULONG tile_allows = allows[tile];
-					''' + fN('''
-					if (flag & grid_{i}) mask_{i} |= tile_allows.s{i};
-					''') + '''
+				bool changed = false;
+				for (uint w = 0; w < WORDS; w++) changed |= new_bits[w] != old_bits[w];
+				if (!changed) return 0;
+
+				store_cell(grid, i, new_bits);
+				UPDATE_ENTROPY(i, new_bits);
+				return 1;
+			}
+
+			__kernel void update_grid(
+				__global CELL* grid, __global const CELL* allows, __global ADJUINT* neighbours,
+				__global uint* changes, const uint turn
+				ENTROPY_ARGS
+			) {
+				if (update_tile(get_global_id(0), grid, allows, neighbours ENTROPY_PASS))
+					changes[turn] = 1;
+			}
+
+			/* re-evaluate a neighbour of a changed tile, unless another
+			 * work-item already claimed it this turn */
+			void update_neighbour(
+				uint i, uint stamp,
+				__global CELL* grid, __global const CELL* allows, __global ADJUINT* neighbours,
+				__global uint* claimed, __global uint* next, __global uint* next_size
+				ENTROPY_ARGS
+			) {
+				if (atomic_xchg(&claimed[i], stamp) == stamp) return;
+
+				/* overconstrained tiles are left for the observer,
+				 * there is no point in flooding the world with zeroes */
+				if (update_tile(i, grid, allows, neighbours ENTROPY_PASS) && !is_empty(grid, i))
+					next[atomic_inc(next_size)] = i;
+			}
+
+			/* the launch size is only an upper bound,
+			 * the actual frontier length stays on the device */
+			__kernel void update_frontier(
+				const uint stamp,
+				__global CELL* grid, __global const CELL* allows, __global ADJUINT* neighbours,
+				__global uint* claimed, __global const uint* frontier, __global uint* next,
+				__global uint* sizes, const uint turn
+				ENTROPY_ARGS
+			) {
+				uint k = get_global_id(0);
+				if (k >= sizes[turn]) return;
+
+				ADJUINT around = get_neighbours(frontier[k], neighbours);
+				''' + fN('''
+				update_neighbour(around.s{i}, stamp, grid, allows, neighbours, claimed, next, &sizes[turn + 1] ENTROPY_PASS);
+				''') + '''
+			}
+			''').build(cache_dir=cache.program_directory())
+
+		if tiled:
+			self.build_tiled(ctx, config, entropy, block)
+
+	def get_block(self, block, max_cells):
+		# as many cells as a work-group and its local memory can hold, up to 256, split evenly over the axes
+		dims = len(self.model.world_shape)
+		if block is None:
+			bits = min(8, max_cells.bit_length() - 1)
+			block = tuple(1 << (bits // dims + (axis < bits % dims)) for axis in range(dims))
+		elif isinstance(block, int):
+			block = (block,) * dims
+		return tuple(min(size, world) for size, world in zip(block, self.model.world_shape))
+
+	def build_tiled(self, ctx, config, entropy, block):
+		# one work-group per block of the world, which propagates within the block in local memory
+		# until it settles, and only then writes back. a sweep moves constraints across whole blocks
+		device = ctx.devices[0]
+		# leaving half of the local memory to the compiler, wide cells make for smaller blocks
+		cell_size = self.model.words * self.model.cell_dtype.itemsize
+		self.block = self.get_block(block, min(device.max_work_group_size, device.local_mem_size // 2 // cell_size))
+
+		while True:
+			self.build_blocks(ctx, config, entropy)
+			limit = self.tiled_program.update_blocks.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, device)
+			if self.block_size <= limit:
+				return
+			if block is not None:
+				raise ValueError('blocks of {} tiles are more than the {} work-items a work-group can have on this device'.format(self.block_size, limit))
+			# the kernel needs more registers than the device has for a full work-group, smaller blocks then
+			self.block = self.get_block(None, limit)
+
+	def build_blocks(self, ctx, config, entropy):
+		self.block_size = int(np.prod(self.block))
+		self.blocks_shape = tuple(-(-size // block) for size, block in zip(self.model.world_shape, self.block))
+		fN = config['forNeighbour']
+
+		self.tiled_program = cl.Program(ctx, config['preamble'] + entropy + self.mask_source + '''
+			#define SIZE {}
+			#define DIMS {}
+			#define BLOCK_SIZE {}
+
+			__constant uint world_shape[] = {{ {} }};
+			__constant uint block_shape[] = {{ {} }};
+			__constant uint blocks_shape[] = {{ {} }};
+		'''.format(
+			self.size, len(self.block), self.block_size,
+			', '.join(str(size) for size in self.model.world_shape),
+			', '.join(str(size) for size in self.block),
+			', '.join(str(size) for size in self.blocks_shape)
+		) + r'''//CL//
+
+			/* position of a tile in the local copy of the block starting at origin, -1 outside of it */
+			int block_slot(uint index, const uint* origin) {
+				int slot = 0;
+				int scale = 1;
+				for (int axis = DIMS - 1; axis >= 0; axis--) {
+					int pos = (int)(index % world_shape[axis]) - (int)origin[axis];
+					if (pos < 0 || pos >= (int)block_shape[axis]) return -1;
+					slot += pos * scale;
+					scale *= block_shape[axis];
+					index /= world_shape[axis];
+				}
+				return slot;
+			}
+
+			__kernel void update_blocks(
+				__global CELL* grid, __global const CELL* allows, __global ADJUINT* neighbours,
+				__global uint* changes, const uint turn
+				ENTROPY_ARGS
+			) {
+				__local CELL cells[BLOCK_SIZE * WORDS];
+				/* whether a round changed anything, alternating so one can be cleared while the other is read */
+				__local uint changed[2];
+
+				uint lid = get_local_id(0);
+				uint world = get_global_id(1);
+
+				/* tile of this work-item, blocks at the far edges may stick out of the world */
+				uint origin[DIMS];
+				uint block = get_group_id(0);
+				uint offset = lid;
+				uint index = 0;
+				uint scale = 1;
+				bool inside = true;
+				for (int axis = DIMS - 1; axis >= 0; axis--) {
+					origin[axis] = block % blocks_shape[axis] * block_shape[axis];
+					uint pos = origin[axis] + offset % block_shape[axis];
+					inside = inside && pos < world_shape[axis];
+					index += pos * scale;
+					scale *= world_shape[axis];
+					block /= blocks_shape[axis];
+					offset /= block_shape[axis];
 				}
 
-				ulong new_bits = old_bits ''' + fN('& mask_{i}', '') + ''';
-				grid[i] = new_bits;
-				return old_bits != new_bits;
+				uint i = world * SIZE + index;
+				CELL old_bits[WORDS], bits[WORDS], new_bits[WORDS], neighbour[WORDS];
+				for (uint w = 0; w < WORDS; w++) {
+					old_bits[w] = inside ? grid[i * WORDS + w] : 0;
+					bits[w] = old_bits[w];
+					cells[lid * WORDS + w] = bits[w];
+				}
+
+				/* neighbours in the block are read from local memory as they change,
+				 * the ones around it only once from the grid, they are updated by the next sweep */
+				ADJUINT next = inside ? neighbours[index] + world * SIZE : (ADJUINT)(i);
+				''' + fN('''
+				int slot_{i} = block_slot(next.s{i} - world * SIZE, origin);
+				CELL halo_{i}[WORDS];
+				for (uint w = 0; w < WORDS; w++) halo_{i}[w] = inside && slot_{i} < 0 ? grid[next.s{i} * WORDS + w] : 0;
+				''') + '''
+
+				if (lid == 0) changed[0] = 0;
+				barrier(CLK_LOCAL_MEM_FENCE);
+
+				for (uint round = 0;; round++) {
+					for (uint w = 0; w < WORDS; w++) new_bits[w] = bits[w];
+					if (inside) {
+						/* past the edge of a world that doesn't wrap around a tile is its own neighbour */
+						''' + fN('''
+						if (next.s{i} != i) {{
+							for (uint w = 0; w < WORDS; w++) neighbour[w] = slot_{i} < 0 ? halo_{i}[w] : cells[slot_{i} * WORDS + w];
+							apply_mask(new_bits, neighbour, {i}, allows);
+						}}
+						''') + '''
+					}
+
+					/* everyone has read the block before anything in it changes */
+					barrier(CLK_LOCAL_MEM_FENCE);
+					if (lid == 0) changed[(round + 1) & 1] = 0;
+					bool differs = false;
+					for (uint w = 0; w < WORDS; w++) differs |= new_bits[w] != bits[w];
+					if (differs) {
+						for (uint w = 0; w < WORDS; w++) {
+							bits[w] = new_bits[w];
+							cells[lid * WORDS + w] = bits[w];
+						}
+						changed[round & 1] = 1;
+					}
+					barrier(CLK_LOCAL_MEM_FENCE);
+					if (!changed[round & 1]) break;
+				}
+
+				bool differs = false;
+				for (uint w = 0; w < WORDS; w++) differs |= bits[w] != old_bits[w];
+				if (!differs) return;
+				store_cell(grid, i, bits);
+				UPDATE_ENTROPY(i, bits);
+				changes[turn] = 1;
 			}
-			'''
-		)
-
-	def propagate(self, grid, index, collapsed):
-		grid[np.unravel_index(index, self.model.world_shape)] = collapsed
-		turn, changes = 0, 1
-		while changes > 0:
-			changes = self.update_grid(grid, self.allows_buf, self.neighbours_buf).get()
-			turn += 1
-		print('propagated in {} turns'.format(turn))
+			''').build(cache_dir=cache.program_directory())
+
+	def launch_sweep(self, grid, turn):
+		queue = grid.queue
+		if self.tiled:
+			blocks = int(np.prod(self.blocks_shape))
+			event = self.tiled_program.update_blocks(
+				queue, (blocks * self.block_size, self.batch), (self.block_size, 1),
+				grid.data, self.allows_buf.data, self.neighbours_buf.data,
+				self.changes.data, np.uint32(turn),
+				*self.entropy_args
+			)
+			name = 'update_blocks'
+		else:
+			event = self.program.update_grid(
+				queue, (self.batch * self.size,), None,
+				grid.data, self.allows_buf.data, self.neighbours_buf.data,
+				self.changes.data, np.uint32(turn),
+				*self.entropy_args
+			)
+			name = 'update_grid'
+		if self.hooks:
+			self.hooks.kernel(name, event)
+
+	def propagate_sweep(self, grid):
+		queue = grid.queue
+		turn = 0
+		while True:
+			self.changes.fill(0, queue=queue)
+			for k in range(self.sync_every):
+				self.launch_sweep(grid, k)
+
+			changes = self.changes.get(queue=queue)
+			self.transferred += changes.nbytes
+			settled = np.flatnonzero(changes == 0)
+			if len(settled):
+				return turn + int(settled[0]) + 1
+			turn += self.sync_every
+
+	def propagate_frontier(self, grid, indices):
+		queue = grid.queue
+		current, following = self.frontiers
+		size = len(indices)
+		indices = np.asarray(indices, dtype=cl.cltypes.uint)
+		current[:size].set(indices, queue=queue)
+		self.transferred += indices.nbytes
+
+		turn = 0
+		while True:
+			self.frontier_sizes.fill(0, queue=queue)
+			self.frontier_sizes[:1].fill(size, queue=queue)
+
+			# every tile in the frontier can at most claim all of its neighbours
+			bound = size
+			for k in range(self.sync_every):
+				self.stamp = self.stamp % 0xffffffff + 1
+				event = self.program.update_frontier(
+					queue, (bound,), None,
+					np.uint32(self.stamp),
+					grid.data, self.allows_buf.data, self.neighbours_buf.data,
+					self.claimed.data, current.data, following.data,
+					self.frontier_sizes.data, np.uint32(k),
+					*self.entropy_args
+				)
+				if self.hooks:
+					self.hooks.kernel('update_frontier', event)
+				current, following = following, current
+				bound = min(bound * self.model.adjacent, self.batch * self.size)
+
+			sizes = self.frontier_sizes.get(queue=queue)
+			self.transferred += sizes.nbytes
+			settled = np.flatnonzero(sizes[1:] == 0)
+			if len(settled):
+				return turn + int(settled[0]) + 1
+			turn += self.sync_every
+			size = int(sizes[-1])
+
+	def propagate_cells(self, grid, indices):
+		# indices are flat across all worlds, the cells are already collapsed
+		if not len(indices):
+			self.turns = 0
+		elif self.frontier:
+			self.turns = self.propagate_frontier(grid, indices)
+		else:
+			self.turns = self.propagate_sweep(grid)
+		return self.turns
+
+	def propagate(self, grid, index, collapsed, observed=True):
+		# the collapse kernels already wrote cells collapsed by the observer,
+		# others (e.g. after backtracking) are written here and get their entropy updated
+		if not observed:
+			grid[np.unravel_index(index, self.model.world_shape)] = collapsed
+			self.transferred += grid.dtype.itemsize * self.model.words
+			if self.observer:
+				self.observer.refresh_cell(grid, index)
+		return self.propagate_cells(grid, [index])
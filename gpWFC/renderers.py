@@ -0,0 +1,128 @@
+import numpy as np
+import pyglet
+from pyglet.extlibs import png
+from .models import SpriteTile, PatternTile
+
+def read_png(file):
+	# any PNG as an RGBA array of shape (height, width, 4)
+	reader = png.Reader(filename=file) if isinstance(file, str) else png.Reader(file=file)
+	width, height, rows, _ = reader.asRGBA8()
+	return np.vstack([np.frombuffer(bytes(row), dtype=np.uint8) for row in rows]).reshape(height, width, 4)
+
+def write_png(file, pixels):
+	# uint8 array of shape (height, width) or (height, width, 1-4)
+	pixels = np.asarray(pixels, dtype=np.uint8)
+	if pixels.ndim == 2:
+		pixels = pixels[..., np.newaxis]
+	height, width, n = pixels.shape
+	writer = png.Writer(width, height, greyscale=n < 3, alpha=n % 2 == 0)
+	if isinstance(file, str):
+		with open(file, 'wb') as f:
+			writer.write(f, pixels.reshape(height, -1))
+	else:
+		writer.write(file, pixels.reshape(height, -1))
+
+def over(top, bottom):
+	# alpha compositing of premultiplied RGBA floats
+	return top + bottom * (1 - top[..., 3:])
+
+class AtlasRenderer(object):
+	# draws the same as PreviewWindow for plain tiles
+	colors = ( (0, 0, 255), (255, 0, 0), (0, 255, 0), (0, 0, 255) )
+	rotations = {4: [0, 90, 180, 270], 6: [0, 90, None, 180, 270, None]}
+
+	def __init__(self, model, edge_image='tile.png'):
+		self.model = model
+		self.edge_image = edge_image
+		self.atlas = self.build_atlas()
+		self.tile_size = self.atlas.shape[1]
+
+	def load(self, source):
+		if isinstance(source, str):
+			# found the same way pyglet finds the images of the previews, without needing a window
+			with pyglet.resource.file(source) as f:
+				pixels = read_png(f)
+		else:
+			# already loaded by a preview, rows from the top
+			data = source.get_image_data().get_data('RGBA', -source.width * 4)
+			pixels = np.frombuffer(data, dtype=np.uint8).reshape(source.height, source.width, 4)
+		return pixels.astype(np.float32) / 255
+
+	def premultiply(self, image, color=(255, 255, 255)):
+		rgb = image[..., :3] * np.array(color, dtype=np.float32) / 255
+		alpha = image[..., 3:]
+		return np.concatenate([rgb * alpha, alpha], axis=-1)
+
+	def build_atlas(self):
+		# one premultiplied RGBA image per tile, rotated clockwise like the sprites
+		images = {}
+		atlas = []
+		for tile in self.model.tiles:
+			if isinstance(tile, PatternTile):
+				# a single pixel in the colour of the pattern, grey levels for samples without colours
+				if tile.color is None:
+					color = np.full(3, tile.pattern[0, 0] / max(1, max(t.pattern.max() for t in self.model.tiles)))
+				else:
+					color = np.asarray(tile.color, dtype=np.float32)[:3] / 255
+				atlas.append(np.concatenate([color, [1]]).astype(np.float32).reshape(1, 1, 4))
+				continue
+
+			if isinstance(tile, SpriteTile):
+				if not tile.source in images:
+					images[tile.source] = self.premultiply(self.load(tile.source))
+				atlas.append(np.rot90(images[tile.source], k=-tile.rotation))
+				continue
+
+			# coloured edge markers, one for each edge that isn't empty
+			if not self.edge_image in images:
+				images[self.edge_image] = self.load(self.edge_image)
+			edge = images[self.edge_image]
+			image = np.zeros_like(edge)
+			for direction, adj in enumerate(tile.adj):
+				rotation = self.rotations[len(tile.adj)][direction]
+				if adj < 1 or rotation is None:
+					continue
+				layer = self.premultiply(edge, self.colors[adj])
+				image = over(np.rot90(layer, k=-(rotation // 90)), image)
+			atlas.append(image)
+		return np.stack(atlas)
+
+	def render(self, grid, depth=0):
+		# RGB frame of a 2d grid, or of one slice along the last axis of a 3d one
+		grid = np.asarray(grid)
+		if grid.ndim - len(self.model.cell_shape) == 3:
+			grid = grid[:, :, depth]
+		shape = grid.shape[:2]
+
+		# superposed cells show all of their allowed tiles evenly, contradictions stay black
+		values, inverse = np.unique(grid.reshape((-1,) + self.model.cell_shape), return_inverse=True, axis=0)
+		allowed = self.model.to_bits(values)
+		counts = np.maximum(allowed.sum(axis=1), 1)
+		tiles = (allowed / counts[:, np.newaxis]).astype(np.float32) @ self.atlas.reshape(len(self.model.tiles), -1)
+
+		# cells are indexed by (x, y), from the top left
+		size = self.tile_size
+		cells = tiles.reshape(len(values), size, size, 4)[inverse.reshape(shape)]
+		frame = cells.transpose(1, 2, 0, 3, 4).reshape(shape[1] * size, shape[0] * size, 4)
+		return (np.clip(frame[..., :3], 0, 1) * 255).astype(np.uint8)
+
+	def save(self, grid, name, depth=0):
+		write_png(name, self.render(grid, depth))
+
+	def record(self, runner, pattern='shots/{:04}.png', raw=None, depth=0):
+		# one frame before the first step and one after each step, either as numbered PNGs
+		# or as raw RGB frames written to a binary file (e.g. a pipe to ffmpeg -f rawvideo -pix_fmt rgb24)
+		def emit(iteration):
+			runner.fetch()
+			frame = self.render(runner.grid_array, depth)
+			if raw is not None:
+				raw.write(frame.tobytes())
+			else:
+				write_png(pattern.format(iteration), frame)
+
+		frames = 0
+		emit(frames)
+		for status in runner.run():
+			frames += 1
+			emit(frames)
+		return frames + 1
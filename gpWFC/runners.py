@@ -1,37 +1,226 @@
-from pyopencl import create_some_context, CommandQueue
-from pyopencl.array import to_device
+from collections import OrderedDict
+from pyopencl import create_some_context, CommandQueue, command_queue_properties, enqueue_copy
+from pyopencl.array import to_device, empty_like
+import numpy as np
+from .metrics import timed
 from .observers import CLObserver
 from .propagators import CL1Propagator
+from .traces import TraceWriter
+
+def make_queue(ctx, hooks):
+	# kernel timings need a profiling queue, which is only worth it when someone looks at them
+	if hooks and hooks.profile:
+		return CommandQueue(ctx, properties=command_queue_properties.PROFILING_ENABLE)
+	return CommandQueue(ctx)
 
 class Runner(object):
-	def __init__(self, model, Observer=CLObserver, Propagator=CL1Propagator, ctx=None):
-		if not ctx:
-			ctx = create_some_context()
+	# runners of inpainted regions kept for later edits, each holds its own programs and buffers
+	kept_regions = 4
+
+	def __init__(self, model, Observer=CLObserver, Propagator=CL1Propagator, ctx=None, blocks=None, hooks=None):
 		self.model = model
+		# instrumentation, see metrics.py
+		self.hooks = hooks
+		# kept around to set up runners for regions of the world
+		self.Observer, self.Propagator, self.blocks = Observer, Propagator, blocks
+		self.region_runners = OrderedDict()
+		# TraceWriter recording every step, see start_trace
+		self.trace = None
 
 		self.grid_array = self.model.build_grid()
-		with CommandQueue(ctx) as queue:
-			self.grid = to_device(queue, self.grid_array)
-		self.observer = Observer(model, ctx=ctx)
-		self.propagator = Propagator(model, ctx=ctx)
+		if Observer.on_device:
+			if not ctx:
+				ctx = create_some_context()
+			self.queue = make_queue(ctx, hooks)
+			self.grid = to_device(self.queue, self.grid_array)
+		else:
+			# CPU observers and propagators work on the host grid directly
+			self.grid = self.grid_array
+		self.ctx = ctx
+		self.observer = Observer(model, ctx=ctx, blocks=blocks)
+		self.propagator = Propagator(model, ctx=ctx, observer=self.observer)
+		self.observer.hooks = self.propagator.hooks = hooks
 
-		self.candidate = self.observer.observe(self.grid)[1:]
-		self.done = False
+		# propagation turns and bytes moved between host and device by the runner itself, over its lifetime
+		self.turns = 0
+		self.transferred = 0
 
-	def step(self):
+		self.observer.refresh(self.grid)
+		self.begin()
+
+	def begin(self):
+		# observe the first tile
+		status = self.observe()
+		self.candidate = status[1:]
+		# whether the candidate came from the observer, which already wrote it to the grid
+		self.observed = True
+		self.done = status[0] != 'continue'
+		if status[0] == 'done':
+			self.fetch()
+		return status[0]
+
+	def observe(self, single=False):
+		status = timed(self.hooks, 'observe', self.observer.observe, self.grid, single=single)
+		if self.hooks:
+			self.hooks.observed(self.model, status)
+		return status
+
+	def propagate_cells(self, indices):
+		turns = timed(self.hooks, 'propagate', self.propagator.propagate_cells, self.grid, indices)
+		self.turns += turns
+		if self.hooks:
+			self.hooks.turns(turns)
+
+	def propagate(self):
 		index, collapsed = self.candidate
-		self.propagator.propagate(self.grid, index, collapsed)
-		status = self.observer.observe(self.grid)
+		if np.ndim(index):
+			# the observer collapsed several tiles at once
+			self.propagate_cells(index)
+			return
+
+		turns = timed(self.hooks, 'propagate', self.propagator.propagate, self.grid, index, collapsed, observed=self.observed)
+		self.observed = True
+		self.turns += turns
+		if self.hooks:
+			self.hooks.turns(turns)
+
+	def step(self):
+		self.propagate()
+		status = self.observe()
 
 		if status[0] == 'continue':
 			self.candidate = status[1:]
 		elif status[0] == 'error':
 			self.done = True
 		else:
-			self.grid.get(ary=self.grid_array)
+			self.fetch()
+			self.done = True
 
+		self.record(status[0])
 		return status[0]
 
+	def start_trace(self, file, flush_every=64):
+		# record the grid from now on, and every step after this as the changes to it
+		self.fetch()
+		self.trace = TraceWriter(file, self.model, self.grid_array, None if self.done else self.candidate, flush_every=flush_every)
+		return self.trace
+
+	def stop_trace(self):
+		if self.trace:
+			self.trace.close()
+		self.trace = None
+
+	def record(self, status):
+		if not self.trace:
+			return
+		# the device grid has to be read back after every step for this
+		self.fetch()
+		self.trace.write(status, self.candidate if status == 'continue' else None, self.grid_array)
+
+	def fetch(self):
+		if self.grid is not self.grid_array:
+			timed(self.hooks, 'readback', self.grid.get, ary=self.grid_array)
+			self.transferred += self.grid_array.nbytes
+
+	def restore(self, snapshot):
+		if self.grid is self.grid_array:
+			self.grid_array[...] = snapshot
+		elif isinstance(snapshot, np.ndarray):
+			self.grid.set(snapshot)
+			self.transferred += snapshot.nbytes
+		else:
+			# device-side snapshot, never leaves the device
+			enqueue_copy(self.queue, self.grid.data, snapshot.data)
+		self.observer.refresh(self.grid)
+
+	def reset(self, grid=None, seed=None):
+		# start over, keeping the observer and propagator tables,
+		# with a fresh world or one where some tiles were ruled out already
+		if grid is None:
+			grid = self.model.build_grid()
+		if seed is not None:
+			self.observer.seed(seed)
+		self.restore(grid)
+
+		constrained = np.flatnonzero(self.model.differ(grid, self.model.get_all_tiles()))
+		if len(constrained):
+			self.propagate_cells(constrained)
+		return self.begin()
+
+	def solve(self, grid=None, attempts=1, seed=None):
+		# start over and run until the end, a few times if it fails
+		for attempt in range(attempts):
+			status = self.reset(grid, seed=None if seed is None else seed + attempt)
+			if status == 'continue':
+				status = self.finish()
+			if status == 'done':
+				break
+		return status
+
+	def inpaint(self, mask, attempts=4):
+		# solve the tiles in mask again, leaving the rest of the world as it is
+		mask = np.asarray(mask, dtype=bool)
+		if not mask.any():
+			return 'done'
+		self.fetch()
+
+		# only the bounding box of the region is solved, constrained by the tiles around it.
+		# its size is rounded up to a power of 2, so edits of similar sizes share a runner
+		region = np.nonzero(mask)
+		shape = tuple(min(1 << int(axis.max() - axis.min()).bit_length(), world) for axis, world in zip(region, self.model.world_shape))
+		low = [max(0, min(int(axis.min()), world - size)) for axis, size, world in zip(region, shape, self.model.world_shape)]
+		high = [l + size for l, size in zip(low, shape)]
+		box = tuple(slice(l, h) for l, h in zip(low, high))
+
+		all_tiles = self.model.get_all_tiles()
+		grid = self.grid_array[box].copy()
+		grid[mask[box]] = all_tiles
+
+		# the region keeps wrapping around along the axes it covers entirely,
+		# it is constrained by the tiles around it along the others
+		periodic = tuple(wraps and size == world for wraps, size, world in zip(self.model.wraps, shape, self.model.world_shape))
+
+		for direction, offset in enumerate(self.model.offsets):
+			axis = np.flatnonzero(offset)[0]
+			if periodic[axis]:
+				continue
+			edge = high[axis] if offset[axis] > 0 else low[axis] - 1
+			if self.model.wraps[axis]:
+				edge %= self.model.world_shape[axis]
+			elif not 0 <= edge < self.model.world_shape[axis]:
+				continue
+
+			outside = list(box)
+			outside[axis] = edge
+			outside = tuple(outside)
+			neighbours = self.grid_array[outside].copy()
+			neighbours[mask[outside]] = all_tiles
+
+			side = [slice(None)] * len(shape)
+			side[axis] = -1 if offset[axis] > 0 else 0
+			grid[tuple(side)] &= self.model.get_fitting(neighbours, direction)
+
+		key = shape, periodic
+		if key in self.region_runners:
+			self.region_runners.move_to_end(key)
+		else:
+			self.region_runners[key] = self.make_runner(self.model.with_shape(shape, periodic=periodic))
+			if len(self.region_runners) > self.kept_regions:
+				# the least recently used one goes, with its device buffers
+				self.region_runners.popitem(last=False)
+		runner = self.region_runners[key]
+
+		status = runner.solve(grid, attempts=attempts)
+		if status == 'done':
+			runner.fetch()
+			self.grid_array[box] = runner.grid_array
+			self.restore(self.grid_array)
+		return status
+
+	def make_runner(self, model, **kwargs):
+		# a runner like this one for another model, e.g. a region of the world
+		return type(self)(model, Observer=self.Observer, Propagator=self.Propagator, ctx=self.ctx, blocks=self.blocks, hooks=self.hooks, **kwargs)
+
 	def run(self):
 		while not self.done:
 			yield self.step()
@@ -43,36 +232,189 @@ class Runner(object):
 		return status
 
 class BacktrackingRunner(Runner):
-	def __init__(self, *args, snapshot_every=4, **kwargs):
-		super().__init__(*args, **kwargs)
-		self.snapshot = self.grid_array.copy()
+	def __init__(self, *args, snapshot_every=4, depth=8, **kwargs):
 		self.snapshot_every = snapshot_every
+		self.depth = depth
+		self.snapshots = None
+		super().__init__(*args, **kwargs)
+
+	def make_runner(self, model, **kwargs):
+		return super().make_runner(model, snapshot_every=self.snapshot_every, depth=self.depth, **kwargs)
+
+	def begin(self):
+		if self.snapshots is None:
+			# ring buffer of snapshots, kept wherever the grid lives,
+			# together with the decision that was taken right after each of them
+			if self.grid is self.grid_array:
+				self.snapshots = [np.empty_like(self.grid_array) for i in range(self.depth)]
+			else:
+				self.snapshots = [empty_like(self.grid) for i in range(self.depth)]
+			self.decisions = [None] * self.depth
+
+		self.head = 0
+		self.levels = 0
 		self.snapshot_age = 0
+		self.cautious = 0
 
-	def step(self):
-		index, collapsed = self.candidate
-		self.propagator.propagate(self.grid, index, collapsed)
-		status = self.observer.observe(self.grid)
-		self.grid.get(ary=self.grid_array)
+		# the grid right before the first tile is observed
+		self.save(self.grid)
+		status = super().begin()
+		if status == 'continue':
+			self.decisions[0] = self.candidate
+		return status
+
+	def save(self, grid, decision=None):
+		snapshot = self.snapshots[self.head]
+		if isinstance(snapshot, np.ndarray):
+			snapshot[...] = grid
+		elif isinstance(grid, np.ndarray):
+			snapshot.set(grid)
+			self.transferred += grid.nbytes
+		else:
+			enqueue_copy(self.queue, snapshot.data, grid.data)
+
+		self.decisions[self.head] = decision
+		self.head = (self.head + 1) % self.depth
+		self.levels = min(self.levels + 1, self.depth)
+
+	def read_cell(self, snapshot, index):
+		if isinstance(snapshot, np.ndarray):
+			return snapshot.reshape((-1,) + self.model.cell_shape)[index]
+		cell = np.empty(self.model.words, dtype=snapshot.dtype)
+		enqueue_copy(self.queue, cell, snapshot.data, device_offset=index * cell.nbytes)
+		self.transferred += cell.nbytes
+		return cell if self.model.cell_shape else cell[0]
+
+	def advance(self):
+		self.propagate()
+
+		# the observer collapses the next tile in place, so snapshot the grid before it does
+		self.snapshot_age += 1
+		saved = self.snapshot_age >= self.snapshot_every
+		if saved:
+			timed(self.hooks, 'snapshot', self.save, self.grid)
+			self.snapshot_age = 0
+
+		# collapse one tile at a time for a while after backtracking
+		status = self.observe(single=self.cautious > 0)
+		self.cautious = max(0, self.cautious - 1)
 
 		if status[0] == 'continue':
 			self.candidate = status[1:]
-			self.snapshot_age += 1
-			if self.snapshot_age >= self.snapshot_every:
-				self.snapshot = self.grid_array.copy()
-				self.snapshot_age = 0
-		elif status[0] == 'error':
-			if not self.snapshot is None:
-				print('backtracking {} rounds'.format(self.snapshot_age))
-				self.grid.set(self.snapshot)
-				self.candidate = self.observer.observe(self.grid)[1:]
-				self.snapshot = None
-				self.snapshot_age = self.snapshot_every
-				return self.step()
-			else:
-				print('cannot backtrack anymore')
-				self.done = True
-		else:
+			if saved:
+				self.decisions[(self.head - 1) % self.depth] = self.candidate
+		elif status[0] == 'done':
+			self.fetch()
 			self.done = True
+		else:
+			self.conflict = status[1]
 
 		return status[0]
+
+	def get_nearest(self, indices, target):
+		# distance along each axis, the shorter way around along the axes that wrap
+		shape = np.array(self.model.world_shape)[:, np.newaxis]
+		wraps = np.array(self.model.wraps)[:, np.newaxis]
+		pos = np.array(np.unravel_index(indices, self.model.world_shape))
+		distance = abs(pos - np.array(np.unravel_index(target, self.model.world_shape))[:, np.newaxis])
+		return int(np.where(wraps, np.minimum(distance, shape - distance), distance).sum(axis=0).argmin())
+
+	def backtrack(self):
+		rounds = 0
+		while self.levels:
+			self.head = (self.head - 1) % self.depth
+			self.levels -= 1
+			rounds += 1
+
+			decision = self.decisions[self.head]
+			if decision is None:
+				# the snapshot was already overconstrained
+				continue
+
+			# rule out the tile that was chosen last time and go on from there
+			index, collapsed = decision
+			if np.ndim(index):
+				if not len(index):
+					continue
+				# the tile collapsed closest to the contradiction is the most likely culprit
+				nearest = self.get_nearest(index, self.conflict)
+				index, collapsed = index[nearest], collapsed[nearest]
+			cell = timed(self.hooks, 'readback', self.read_cell, self.snapshots[self.head], index)
+			remaining = self.model.to_int(cell) & ~self.model.to_int(collapsed)
+			if not remaining:
+				continue
+			remaining = self.model.from_int(remaining)
+
+			if self.hooks:
+				self.hooks.backtracked(rounds)
+			timed(self.hooks, 'restore', self.restore, self.snapshots[self.head])
+			self.candidate = index, remaining
+			self.observed = False
+			self.snapshot_age = self.snapshot_every - 1
+			self.cautious = self.snapshot_every * self.depth
+			return True
+
+		return False
+
+	def step(self):
+		status = self.advance()
+		while status == 'error':
+			if not self.backtrack():
+				if self.hooks:
+					self.hooks.backtracked(None)
+				self.done = True
+				break
+			status = self.advance()
+
+		self.record(status)
+		return status
+
+class BatchRunner(object):
+	def __init__(self, model, batch, Observer=CLObserver, Propagator=CL1Propagator, ctx=None, seeds=None, hooks=None):
+		if not ctx:
+			ctx = create_some_context()
+		self.model = model
+		self.batch = batch
+		self.hooks = hooks
+
+		# independent worlds, stacked along the first axis
+		self.grid_array = np.stack([self.model.build_grid()] * batch)
+		self.queue = make_queue(ctx, hooks)
+		self.grid = to_device(self.queue, self.grid_array)
+		self.observer = Observer(model, ctx=ctx, batch=batch, seeds=seeds)
+		self.propagator = Propagator(model, ctx=ctx, observer=self.observer, batch=batch)
+		self.observer.hooks = self.propagator.hooks = hooks
+
+		self.observer.refresh(self.grid)
+
+		self.status = self.observer.observe_all(self.grid)
+		self.done = False
+
+	@property
+	def statuses(self):
+		return [self.observer.statuses[status] for status in self.status[:, 0]]
+
+	def step(self):
+		# worlds that are done or failed are left alone
+		running = np.flatnonzero(self.status[:, 0] == 0)
+		indices = running * self.propagator.size + self.status[running, 1].astype(int)
+		turns = timed(self.hooks, 'propagate', self.propagator.propagate_cells, self.grid, indices)
+		if self.hooks:
+			self.hooks.turns(turns)
+		self.status = timed(self.hooks, 'observe', self.observer.observe_all, self.grid)
+
+		if not (self.status[:, 0] == 0).any():
+			timed(self.hooks, 'readback', self.grid.get, ary=self.grid_array)
+			self.done = True
+
+		return self.statuses
+
+	def run(self):
+		while not self.done:
+			yield self.step()
+
+	def finish(self):
+		statuses = self.statuses
+		for statuses in self.run():
+			pass
+		return statuses
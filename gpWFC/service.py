@@ -0,0 +1,170 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer
+from pyopencl import create_some_context
+from .observers import CLObserver
+from .propagators import CL1Propagator
+from .runners import BacktrackingRunner
+
+reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+class GenerationService(object):
+	# a local HTTP server solving worlds on request. setting up a runner (context, kernels, tables)
+	# takes much longer than solving a small world, so runners are kept warm between jobs
+	def __init__(self, models, Observer=CLObserver, Propagator=CL1Propagator, Runner=BacktrackingRunner, ctx=None, workers=2, **kwargs):
+		# functions building a model for a world shape, by name
+		self.models = models
+		self.Observer, self.Propagator, self.Runner = Observer, Propagator, Runner
+		self.kwargs = kwargs
+		self.workers = workers
+
+		# one context for all runners, created once
+		if Observer.on_device and not ctx:
+			ctx = create_some_context()
+		self.ctx = ctx
+
+		# idle runners by model name and world shape. a runner is only used by one job at a time,
+		# so there are at most as many per model as there are workers
+		self.idle = {}
+		self.executor = ThreadPoolExecutor(workers)
+		self.queue = None
+		self.jobs = 0
+		self.warm_jobs = 0
+
+	def make_runner(self, name, shape):
+		model = self.models[name](shape)
+		return self.Runner(model, Observer=self.Observer, Propagator=self.Propagator, ctx=self.ctx, **self.kwargs)
+
+	def warm(self, name, shape, count=1):
+		# set up runners before the first jobs for them come in
+		shape = tuple(shape)
+		runners = [self.make_runner(name, shape) for i in range(count)]
+		self.idle.setdefault((name, shape), []).extend(runners)
+
+	def solve(self, job):
+		# runs on a worker thread
+		name, shape = job['model'], tuple(job['shape'])
+		start = default_timer()
+		runners = self.idle.setdefault((name, shape), [])
+		try:
+			runner = runners.pop()
+			warm = True
+		except IndexError:
+			runner = self.make_runner(name, shape)
+			warm = False
+		setup = default_timer() - start
+
+		try:
+			status = runner.solve(attempts=job.get('attempts', 1), seed=job.get('seed'))
+			runner.fetch()
+			grid = runner.grid_array.tolist()
+		finally:
+			runners.append(runner)
+
+		self.jobs += 1
+		self.warm_jobs += warm
+		return {
+			'status': status,
+			'grid': grid,
+			'warm': warm,
+			'setup_s': setup,
+			'solve_s': default_timer() - start - setup,
+		}
+
+	def status(self):
+		return {
+			'models': sorted(self.models),
+			'warm': {'{} {}'.format(name, 'x'.join(map(str, shape))): len(runners) for (name, shape), runners in self.idle.items()},
+			'queued': self.queue.qsize() if self.queue else 0,
+			'jobs': self.jobs,
+			'warm_jobs': self.warm_jobs,
+		}
+
+	async def submit(self, job):
+		future = asyncio.get_running_loop().create_future()
+		await self.queue.put((job, future))
+		return await future
+
+	async def work(self):
+		loop = asyncio.get_running_loop()
+		while True:
+			job, future = await self.queue.get()
+			try:
+				result = await loop.run_in_executor(self.executor, self.solve, job)
+			except Exception as e:
+				if not future.cancelled():
+					future.set_exception(e)
+			else:
+				if not future.cancelled():
+					future.set_result(result)
+
+	async def route(self, method, path, body):
+		if path == '/status':
+			return (200, self.status()) if method == 'GET' else (405, {'error': 'use GET'})
+		if path != '/generate':
+			return 404, {'error': 'unknown path {}'.format(path)}
+		if method != 'POST':
+			return 405, {'error': 'use POST'}
+
+		# {"model": name, "shape": [w, h], "seed": 1, "attempts": 4}, only model and shape are needed
+		try:
+			job = json.loads(body or b'{}')
+			job['shape'] = [int(size) for size in job['shape']]
+		except (ValueError, KeyError, TypeError) as e:
+			return 400, {'error': 'bad job: {}'.format(e)}
+		if not job.get('model') in self.models:
+			return 404, {'error': 'unknown model {}'.format(job.get('model'))}
+
+		try:
+			return 200, await self.submit(job)
+		except Exception as e:
+			return 500, {'error': '{}: {}'.format(type(e).__name__, e)}
+
+	async def handle(self, reader, writer):
+		# one request per connection
+		try:
+			method, path, _ = (await reader.readline()).decode().split(' ', 2)
+			headers = {}
+			while True:
+				line = await reader.readline()
+				if line in (b'\r\n', b'\n', b''):
+					break
+				key, value = line.decode().split(':', 1)
+				headers[key.strip().lower()] = value.strip()
+			body = await reader.readexactly(int(headers.get('content-length', 0)))
+		except (ValueError, asyncio.IncompleteReadError):
+			code, result = 400, {'error': 'malformed request'}
+		else:
+			code, result = await self.route(method, path.split('?')[0], body)
+
+		data = json.dumps(result).encode()
+		writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+			code, reasons[code], len(data)).encode() + data)
+		try:
+			await writer.drain()
+		finally:
+			writer.close()
+
+	async def serve(self, host='127.0.0.1', port=8080, path=None):
+		# on a TCP port, or on a Unix socket when a path is given
+		self.queue = asyncio.Queue()
+		workers = [asyncio.ensure_future(self.work()) for i in range(self.workers)]
+		if path:
+			server = await asyncio.start_unix_server(self.handle, path=path)
+		else:
+			server = await asyncio.start_server(self.handle, host, port)
+		try:
+			async with server:
+				await server.serve_forever()
+		finally:
+			for worker in workers:
+				worker.cancel()
+
+	def run(self, **kwargs):
+		try:
+			asyncio.run(self.serve(**kwargs))
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.executor.shutdown()
@@ -0,0 +1,130 @@
+import gzip
+import struct
+import numpy as np
+from .observers import BaseObserver
+
+magic = b'WFCT'
+version = 1
+
+def read_exactly(file, size):
+	data = file.read(size)
+	if len(data) != size:
+		raise EOFError('trace ends in the middle of a step')
+	return data
+
+def pack_indices(indices):
+	return struct.pack('<I', len(indices)) + indices.tobytes()
+
+def unpack_indices(file):
+	count, = struct.unpack('<I', read_exactly(file, 4))
+	return np.frombuffer(read_exactly(file, count * 4), dtype=np.uint32)
+
+def open_gzip(file, mode):
+	# a file name or a binary file object
+	if isinstance(file, str):
+		return gzip.open(file, mode)
+	if mode == 'rb':
+		file.seek(0)
+	return gzip.GzipFile(fileobj=file, mode=mode)
+
+class TraceWriter(object):
+	# the first grid in full, then per step the status, the decision that was taken
+	# and the cells that changed since the step before, gzipped as it goes
+	def __init__(self, file, model, grid, decision=None, flush_every=64):
+		self.file = open_gzip(file, 'wb')
+		self.flush_every = flush_every
+		self.steps = 0
+
+		shape = tuple(model.world_shape)
+		self.cells = int(np.prod(shape))
+		self.grid = np.array(grid).reshape(self.cells, -1)
+		dtype = self.grid.dtype.str.encode()
+
+		self.file.write(magic + struct.pack('<BB', version, len(shape)) + struct.pack('<{}I'.format(len(shape)), *shape))
+		self.file.write(struct.pack('<IB', self.grid.shape[1], len(dtype)) + dtype)
+		self.file.write(self.grid.tobytes())
+		self.write('continue', decision, grid)
+
+	def write(self, status, decision, grid):
+		grid = np.asarray(grid).reshape(self.cells, -1)
+		changed = np.flatnonzero((grid != self.grid).any(axis=1)).astype(np.uint32)
+
+		# several tiles at once in block mode, none once the run is over
+		indices, collapsed = decision if decision is not None else ([], [])
+		indices = np.atleast_1d(np.asarray(indices, dtype=np.uint32))
+		collapsed = np.atleast_1d(np.asarray(collapsed, dtype=self.grid.dtype))
+
+		self.file.write(struct.pack('<B', BaseObserver.statuses.index(status)))
+		self.file.write(pack_indices(indices) + collapsed.tobytes())
+		self.file.write(pack_indices(changed) + grid[changed].tobytes())
+		self.grid[changed] = grid[changed]
+
+		# keep what was written so far readable, should the process die
+		self.steps += 1
+		if self.steps % self.flush_every == 0:
+			self.file.flush()
+
+	def close(self):
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+class Trace(object):
+	# reads traces back, each step gives the status, the collapsed indices and bits, and the whole grid
+	def __init__(self, file):
+		self.file = file
+		f, self.initial = self.open()
+		f.close()
+
+	def open(self):
+		f = open_gzip(self.file, 'rb')
+		header = read_exactly(f, 6)
+		if header[:4] != magic or header[4] != version:
+			raise ValueError('not a trace, or one of another version')
+		dims = header[5]
+		self.world_shape = struct.unpack('<{}I'.format(dims), read_exactly(f, 4 * dims))
+		words, length = struct.unpack('<IB', read_exactly(f, 5))
+		self.dtype = np.dtype(read_exactly(f, length).decode())
+		self.words = words
+		cells = int(np.prod(self.world_shape))
+		grid = np.frombuffer(read_exactly(f, cells * words * self.dtype.itemsize), dtype=self.dtype).reshape(cells, words).copy()
+		return f, grid
+
+	def steps(self):
+		# generator over (status, indices, collapsed, grid), the grid is only valid until the next step
+		f, grid = self.open()
+		shape = self.world_shape + ((self.words,) if self.words > 1 else ())
+		with f:
+			while True:
+				try:
+					status = f.read(1)
+				except EOFError:
+					# the writer died, everything up to its last flush is still there
+					return
+				if not status:
+					return
+				indices = unpack_indices(f)
+				collapsed = np.frombuffer(read_exactly(f, len(indices) * self.words * self.dtype.itemsize), dtype=self.dtype)
+				changed = unpack_indices(f)
+				values = read_exactly(f, len(changed) * self.words * self.dtype.itemsize)
+				grid[changed] = np.frombuffer(values, dtype=self.dtype).reshape(-1, self.words)
+				yield BaseObserver.statuses[status[0]], indices, collapsed, grid.reshape(shape)
+
+	def frame(self, step):
+		# the grid after the given step, 0 being the one the trace started with
+		for i, (status, indices, collapsed, grid) in enumerate(self.steps()):
+			if i == step:
+				return grid.copy()
+		raise IndexError('the trace only has {} steps'.format(i + 1))
+
+	def frames(self, start=0, stop=None):
+		# copies of the grids of a range of steps, e.g. for rendering them in parallel
+		for i, (status, indices, collapsed, grid) in enumerate(self.steps()):
+			if stop is not None and i >= stop:
+				return
+			if i >= start:
+				yield grid.copy()
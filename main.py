@@ -1,15 +1,14 @@
 import numpy as np
+from functools import partial
 
+from gpWFC.metrics import Metrics, PrintHooks
 from gpWFC.models import Model2d, Model3d, Tile
-from gpWFC.observers import CLObserver
-from gpWFC.propagators import CPUPropagator, CL1Propagator
-from gpWFC.previews import PreviewWindow, PreviewWindow3d
+from gpWFC.observers import CLObserver, CPUObserver
+from gpWFC.propagators import CPUPropagator, AC4Propagator, NumpyPropagator, CL1Propagator
 from gpWFC.runners import BacktrackingRunner
 
-if __name__ == '__main__':
-	import sys
-
-	if '3d' in sys.argv[1:]:
+def make_model(three_d=False):
+	if three_d:
 		model = Model3d((4, 4, 2))
 		model.add(Tile((0, 1, 1, 0, 1, 0))) # all green
 		model.add(Tile((2, 0, 0, 2, 0, 1))) # all green
@@ -25,14 +24,58 @@ if __name__ == '__main__':
 			# if bins[2] % 2 == 1:
 			# 	continue
 			model.add(Tile(adj))
+	return model
+
+if __name__ == '__main__':
+	import sys
 
+	model = make_model('3d' in sys.argv[1:])
 	print('{} tiles:'.format(len(model.tiles)))
 
-	Propagator = CL1Propagator
+	Observer, Propagator = CLObserver, CL1Propagator
 	if 'cpu' in sys.argv[1:]:
-		Propagator = CPUPropagator
+		Observer, Propagator = CPUObserver, CPUPropagator
+	elif 'ac4' in sys.argv[1:]:
+		Observer, Propagator = CPUObserver, AC4Propagator
+	elif 'numpy' in sys.argv[1:]:
+		Observer, Propagator = CPUObserver, NumpyPropagator
+	elif 'frontier' in sys.argv[1:]:
+		Propagator = partial(CL1Propagator, frontier=True)
+	elif 'tiled' in sys.argv[1:]:
+		Propagator = partial(CL1Propagator, tiled=True)
+
+	if 'serve' in sys.argv[1:]:
+		from gpWFC.service import GenerationService
+
+		# a warm runner for the default world shape, other shapes are set up on their first job
+		three_d = '3d' in sys.argv[1:]
+		service = GenerationService({'main': lambda shape: make_model(three_d).with_shape(shape)}, Observer=Observer, Propagator=Propagator)
+		service.warm('main', model.world_shape)
+		print('serving on http://127.0.0.1:8080, POST {{"model": "main", "shape": {}, "seed": 1}} to /generate'.format(list(model.world_shape)))
+		service.run()
+		sys.exit()
 
-	runner = BacktrackingRunner(model, Observer=CLObserver, Propagator=Propagator)
+	if 'farm' in sys.argv[1:]:
+		from timeit import default_timer
+		from gpWFC.farm import SeedFarm
+
+		if Observer.on_device:
+			Observer, Propagator = CPUObserver, NumpyPropagator
+
+		start = default_timer()
+		with SeedFarm(partial(make_model, '3d' in sys.argv[1:]), range(64), Observer=Observer, Propagator=Propagator) as farm:
+			statuses = farm.finish()
+		print('{} done, {} failed after {}s ({}s per world)'.format(
+			statuses.count('done'), statuses.count('error'), default_timer() - start, farm.timings.mean()))
+		sys.exit()
+
+	blocks = None
+	if 'blocks' in sys.argv[1:]:
+		blocks = 4
+
+	# log every step when watching, only collect timings when measuring
+	hooks = Metrics() if 'silent' in sys.argv[1:] else PrintHooks()
+	runner = BacktrackingRunner(model, Observer=Observer, Propagator=Propagator, blocks=blocks, hooks=hooks)
 
 	if 'silent' in sys.argv[1:]:
 		from timeit import default_timer
@@ -40,7 +83,18 @@ if __name__ == '__main__':
 		start = default_timer()
 		status = runner.finish()
 		print('{} after {}s'.format(status, default_timer() - start))
+		for name, phase in hooks.summary()['phases'].items():
+			print('  {}: {}s in {} calls'.format(name, phase['seconds'], phase['calls']))
+	elif 'headless' in sys.argv[1:]:
+		from gpWFC.renderers import AtlasRenderer
+
+		# frames are drawn with numpy, without a window
+		frames = AtlasRenderer(model).record(runner)
+		print('wrote {} frames to shots/'.format(frames))
 	else:
+		# needs a display
+		from gpWFC.previews import PreviewWindow, PreviewWindow3d
+
 		Preview = PreviewWindow
 		if '3d' in sys.argv[1:]:
 			Preview = PreviewWindow3d